@@ -0,0 +1,215 @@
+'''Offline microbenchmarks for the hot functions of the music cog.
+
+Needs the bot's requirements installed, but no network and no Discord connection.
+Run from the repository root:
+
+    python -m benchmarks.bench_music --output results.json
+    python -m benchmarks.bench_music --compare results.json --threshold 0.25
+
+With --compare the run fails (exit code 1) if any benchmark got slower than the
+baseline by more than the threshold.
+'''
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import sys
+import time
+import types
+
+from cogs import music
+from utils.config import ConfigSnapshot
+
+SIZES = (10, 100, 1000)
+BLACKLIST_SIZES = (10, 100, 1000, 10000)
+REPEAT = 5
+MIN_TIME = 0.2
+
+
+class FakeMember:
+    def __init__(self, member_id, deaf=False, self_deaf=False, channel=None):
+        self.id = member_id
+        self.name = 'member{}'.format(member_id)
+        self.mention = '<@{}>'.format(member_id)
+        self.bot = False
+        self.voice = types.SimpleNamespace(deaf=deaf, self_deaf=self_deaf, channel=channel)
+
+    def __str__(self):
+        return '{}#0001'.format(self.name)
+
+
+def fake_info(idx, description_length=2000):
+    return {
+        'extractor': 'youtube',
+        'id': 'video{:06d}'.format(idx),
+        'ext': 'webm',
+        'title': 'Some song title number {}'.format(idx),
+        'uploader': 'Uploader {}'.format(idx % 50),
+        'description': ('lorem ipsum dolor sit amet ' * (description_length // 27 + 1))[:description_length],
+        'duration': 180 + idx % 300,
+        'webpage_url': 'https://www.youtube.com/watch?v=video{:06d}'.format(idx),
+    }
+
+
+def fake_song(idx):
+    channel = types.SimpleNamespace(id=1, guild=types.SimpleNamespace(id=1))
+    return music.SongInfo(fake_info(idx), FakeMember(idx % 20), channel)
+
+
+def fake_bot():
+    return types.SimpleNamespace(
+        loop=asyncio.new_event_loop(),
+        user=types.SimpleNamespace(id=0),
+        config=ConfigSnapshot({'prefix': '*', 'voice_channel': {}, 'song_length': 1200, 'percentage_skip': 0.5}),
+    )
+
+
+def run_sync(coro):
+    '''Runs a coroutine that never suspends without the overhead of an event loop.'''
+    try:
+        coro.send(None)
+    except StopIteration as result:
+        return result.value
+    raise RuntimeError('Coroutine suspended')
+
+
+def measure(func):
+    '''Returns the best time per call in seconds.'''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIME:
+            break
+        number *= 10 if elapsed < MIN_TIME / 10 else 2
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+def bench_can_content_be_played():
+    song = fake_song(999999)
+    for size in BLACKLIST_SIZES:
+        cog = types.SimpleNamespace(
+            bot=fake_bot(),
+            blacklisted_videos=music.BlacklistMatcher('blocked phrase {}'.format(i) for i in range(size)),
+        )
+        yield 'can_content_be_played[blacklist={}]'.format(size), lambda cog=cog: run_sync(music.Music.can_content_be_played(cog, song))
+
+
+def bench_playlist():
+    for size in SIZES:
+        playlist = music.Playlist(maxsize=0)
+        for idx in range(size):
+            playlist.add_song(fake_song(idx))
+
+        def track_change(playlist=playlist):
+            playlist.add_song(playlist.get_song())
+            return str(playlist)
+        yield 'Playlist.__str__[cached,songs={}]'.format(size), lambda playlist=playlist: str(playlist)
+        yield 'Playlist.__str__[after_track_change,songs={}]'.format(size), track_change
+
+        def delete_middle(playlist=playlist, size=size):
+            song = playlist.delete_song(size // 2)
+            playlist.add_song(song)
+        yield 'Playlist.delete_song[songs={}]'.format(size), delete_middle
+
+
+def bench_duration_to_str():
+    durations = (0, 1, 59, 61, 3599, 3661, 86399, 90061, 1234567)
+    yield 'duration_to_str', lambda: [music.duration_to_str(duration) for duration in durations]
+
+
+def bench_voice_listeners():
+    for size in SIZES:
+        channel = types.SimpleNamespace(id=1, members=[])
+        channel.members = [FakeMember(idx, deaf=idx % 7 == 0, self_deaf=idx % 11 == 0, channel=channel) for idx in range(size)]
+        listeners = music.VoiceListeners()
+        yield 'VoiceListeners.count[members={}]'.format(size), lambda listeners=listeners, channel=channel: listeners.count(channel)
+
+        member = channel.members[1]
+        deafened = types.SimpleNamespace(deaf=False, self_deaf=True, channel=channel)
+
+        def toggle_deaf(listeners=listeners, member=member, deafened=deafened):
+            listeners.update(member, member.voice, deafened)
+            listeners.update(member, deafened, member.voice)
+        yield 'VoiceListeners.update[members={}]'.format(size), toggle_deaf
+
+
+def bench_guild_music_state():
+    bot = fake_bot()
+    yield 'GuildMusicState()', lambda: music.GuildMusicState(bot)
+
+
+BENCHMARKS = (bench_can_content_be_played, bench_playlist, bench_duration_to_str, bench_voice_listeners,
+              bench_guild_music_state)
+
+
+def run(name_filter=None):
+    results = {}
+    for group in BENCHMARKS:
+        for name, func in group():
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = measure(func)
+            print('{:<55} {:>12.3f} us'.format(name, results[name] * 1e6))
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = seconds / baseline[name] - 1
+        marker = ''
+        if change > threshold:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print('{:<55} {:>+8.1%}{}'.format(name, change, marker))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline microbenchmarks for the music cog.')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown against the baseline (default: 0.25)')
+    parser.add_argument('--filter', help='Only run benchmarks whose name contains this string')
+    args = parser.parse_args()
+
+    # Keep the cog's INFO logging out of the measurements
+    logging.disable(logging.INFO)
+    results = run(args.filter)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'meta': {
+                    'date': datetime.datetime.now().isoformat(),
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                },
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} benchmark(s) regressed by more than {:.0%}'.format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,790 @@
+'''End-to-end load simulator for the music cog.
+
+Drives the real Music cog through hundreds of simulated guilds without touching
+Discord or YouTube:
+
+- guilds, channels, members and messages are in-memory stand-ins and REST calls
+  (messages, reactions, presence) sleep for ``--api-latency`` instead,
+- voice clients run a player thread per guild that pulls 20ms frames from the
+  real FFmpeg sources exactly like discord.py does (including Opus encoding when
+  libopus is available), without sending anything,
+- youtube_dl is replaced by a client for a local HTTP media server, running in its
+  own process, that serves generated tracks with configurable extraction and
+  download latencies.
+
+Every simulated guild issues play, skip, queue and remove commands as a Poisson
+process at the configured rates. Needs the bot's requirements and FFmpeg.
+Run from the repository root:
+
+    python -m benchmarks.soak --guilds 200 --duration 600 --output soak.json
+
+The report lists command latency percentiles, track transition gaps (end of a
+track until the first frame of the next one), late frames, CPU per voice stream
+and memory growth.
+'''
+
+import argparse
+import asyncio
+import collections
+import http.server
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+import discord
+import discord.ext.commands as commands
+import yaml
+
+from cogs import music
+from utils.config import ConfigSnapshot
+
+FRAME_LENGTH = 0.02 # Seconds of audio per voice packet, as in discord.py
+
+logger = logging.getLogger('soak')
+
+
+def percentiles(values, points=(50, 90, 99)):
+    '''Nearest-rank percentiles plus the maximum, None for empty samples.'''
+    if not values:
+        return dict.fromkeys(['p{}'.format(point) for point in points] + ['max'])
+    ordered = sorted(values)
+    result = {'p{}'.format(point): ordered[max(0, math.ceil(point / 100 * len(ordered)) - 1)] for point in points}
+    result['max'] = ordered[-1]
+    return result
+
+
+def resident_memory():
+    '''Current RSS in bytes, the peak RSS where /proc is not available.'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Media server
+
+def generate_tracks(directory, count, min_length, max_length, rng):
+    '''Renders ``count`` sine wave tracks with FFmpeg and returns their id -> duration map.'''
+    os.makedirs(directory, exist_ok=True)
+    tracks = {}
+    for index in range(count):
+        track_id = 'track{:04d}'.format(index)
+        duration = round(rng.uniform(min_length, max_length), 2)
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', 'sine=frequency={}:sample_rate=48000:duration={}'.format(220 + index * 5, duration),
+                        '-ac', '2', '-c:a', 'flac', os.path.join(directory, track_id + '.flac')], check=True)
+        tracks[track_id] = duration
+    return tracks
+
+
+def track_info(base_url, track_id, duration):
+    return {
+        'id': track_id,
+        'extractor': 'soak',
+        'extractor_key': 'Soak',
+        'ext': 'flac',
+        'title': 'Simulated {}'.format(track_id),
+        'uploader': 'Soak test',
+        'duration': duration,
+        'webpage_url': '{}/watch/{}'.format(base_url, track_id),
+        'url': '{}/media/{}.flac'.format(base_url, track_id),
+    }
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        track_ids = sorted(server.tracks)
+        if url.path == '/search':
+            query = urllib.parse.parse_qs(url.query).get('q', [''])[0]
+            track_id = track_ids[zlib.crc32(query.encode('utf-8')) % len(track_ids)]
+        else:
+            track_id = os.path.splitext(url.path.rsplit('/', 1)[-1])[0]
+        if track_id not in server.tracks:
+            self.send_error(404)
+            return
+
+        if url.path.startswith('/media/'):
+            time.sleep(server.download_latency)
+            with open(os.path.join(server.directory, track_id + '.flac'), 'rb') as track:
+                body = track.read()
+            content_type = 'audio/flac'
+        else:
+            time.sleep(server.extract_latency)
+            body = json.dumps(track_info(server.base_url, track_id, server.tracks[track_id])).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve_media(directory, tracks, extract_latency, download_latency, ready):
+    server = MediaServer(('127.0.0.1', 0), MediaHandler)
+    server.directory = directory
+    server.tracks = tracks
+    server.extract_latency = extract_latency
+    server.download_latency = download_latency
+    server.base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    ready.put(server.base_url)
+    server.serve_forever()
+
+
+class SimulatedYoutubeDL:
+    '''Stands in for SongInfo.ytdl, answering from the media server.'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def prepare_filename(self, info):
+        return music.SongInfo.ytdl_opts['outtmpl'] % info
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=60) as response:
+            return response.read()
+
+    def extract_info(self, url, download=False, process=True):
+        if url.startswith(self.base_url):
+            track_id = os.path.splitext(urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1])[0]
+            info = json.loads(self._get('/info/' + track_id))
+        else:
+            info = json.loads(self._get('/search?' + urllib.parse.urlencode({'q': url})))
+        if download:
+            filename = self.prepare_filename(info)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # Guilds can download the same track at once
+            part_name = '{}.{}.part'.format(filename, threading.get_ident())
+            with open(part_name, 'wb') as part:
+                part.write(self._get('/media/{}.flac'.format(info['id'])))
+            os.replace(part_name, filename)
+        return info
+
+
+# Discord stand-ins
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list) # command -> seconds
+        self.failures = collections.Counter() # command -> failed invocations
+        self.errors = collections.Counter() # (command, error type) -> count
+        self.gaps = []
+        self.frames = 0
+        self.late_frames = 0
+        self.api_calls = collections.Counter()
+        self.samples = [] # (elapsed, playing streams, rss)
+
+
+class SimRole:
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+
+
+class SimVoiceState:
+    def __init__(self, channel, deaf=False, self_deaf=False):
+        self.channel = channel
+        self.deaf = deaf
+        self.self_deaf = self_deaf
+
+
+class SimMember:
+    def __init__(self, member_id, name, guild, roles=()):
+        self.id = member_id
+        self.name = name
+        self.discriminator = '0001'
+        self.guild = guild
+        self.roles = ([guild.default_role] if guild is not None else []) + list(roles)
+        self.voice = None
+        self.bot = False
+
+    @property
+    def mention(self):
+        return '<@{}>'.format(self.id)
+
+    @property
+    def display_name(self):
+        return self.name
+
+    def __str__(self):
+        return '{}#{}'.format(self.name, self.discriminator)
+
+
+class SimMessage:
+    def __init__(self, message_id, content, author, channel, simulation):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self._state = None
+        self._simulation = simulation
+
+    async def add_reaction(self, emoji):
+        await self._simulation.api_call('reaction')
+
+    async def remove_reaction(self, emoji, member):
+        await self._simulation.api_call('reaction')
+
+
+class SimTextChannel:
+    def __init__(self, channel_id, guild, simulation):
+        self.id = channel_id
+        self.name = 'music-{}'.format(guild.id)
+        self.guild = guild
+        self._simulation = simulation
+
+    @property
+    def mention(self):
+        return '<#{}>'.format(self.id)
+
+    async def send(self, content=None, **kwargs):
+        await self._simulation.api_call('message')
+        return SimMessage(next(self._simulation.ids), str(content), self.guild.me, self, self._simulation)
+
+
+class SimVoiceChannel:
+    def __init__(self, channel_id, guild, simulation):
+        self.id = channel_id
+        self.name = 'voice-{}'.format(guild.id)
+        self.guild = guild
+        self.members = []
+        self._simulation = simulation
+
+    @property
+    def mention(self):
+        return '<#{}>'.format(self.id)
+
+    def __repr__(self):
+        return '<SimVoiceChannel id={}>'.format(self.id)
+
+    async def connect(self):
+        await self._simulation.api_call('voice_connect')
+        voice_client = SimVoiceClient(self, self._simulation)
+        self.guild.voice_client = voice_client
+        self.guild.me.voice = SimVoiceState(self)
+        self.members.append(self.guild.me)
+        return voice_client
+
+
+class SimGuild:
+    def __init__(self, guild_id, simulation):
+        self.id = guild_id
+        self.name = 'guild-{}'.format(guild_id)
+        self.voice_client = None
+        self.default_role = SimRole(guild_id, '@everyone')
+        self.dj_role = SimRole(next(simulation.ids), 'DJs')
+        self.roles = [self.default_role, self.dj_role]
+        self.me = SimMember(simulation.bot_user.id, simulation.bot_user.name, self)
+        self.me.bot = True
+        self.text_channel = SimTextChannel(next(simulation.ids), self, simulation)
+        self.voice_channel = SimVoiceChannel(next(simulation.ids), self, simulation)
+        self.members = {}
+        self.channels = {channel.id: channel for channel in (self.text_channel, self.voice_channel)}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class SimVoiceClient:
+    '''Voice client whose player thread consumes sources in real time like discord.py's AudioPlayer.'''
+
+    def __init__(self, channel, simulation):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self._simulation = simulation
+        self._connected = True
+        self._player = None
+        self._encoder = None
+        self._ended_at = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def encode(self, data):
+        if self._encoder is None:
+            self._encoder = discord.opus.Encoder()
+        return self._encoder.encode(data, self._encoder.SAMPLES_PER_FRAME)
+
+    def play(self, source, *, after=None):
+        if not self._connected:
+            raise discord.ClientException('Not connected to voice.')
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._player = SimAudioPlayer(self, source, after, self._ended_at)
+        self._ended_at = None
+        self._player.start()
+
+    def track_ended(self):
+        self._ended_at = time.perf_counter()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def move_to(self, channel):
+        await self._simulation.api_call('voice_connect')
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        if not self._connected and not force:
+            return
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+        if self.guild.me in self.channel.members:
+            self.channel.members.remove(self.guild.me)
+        self.guild.me.voice = None
+        await self._simulation.api_call('voice_disconnect')
+
+
+class SimAudioPlayer(threading.Thread):
+    def __init__(self, client, source, after, previous_end):
+        super().__init__(daemon=True, name='soak-player-{}'.format(client.guild.id))
+        self.client = client
+        self.source = source
+        self.after = after
+        self.previous_end = previous_end
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self.stats = client._simulation.stats
+
+    def run(self):
+        error = None
+        try:
+            self._do_run()
+        except Exception as exc:
+            error = exc
+        finally:
+            self.client.track_ended()
+            self.source.cleanup()
+            self._end.set()
+            if self.after is not None:
+                try:
+                    self.after(error)
+                except Exception:
+                    logger.exception('Calling the after function failed.')
+
+    def _do_run(self):
+        encode = not self.source.is_opus() and self.client._simulation.encode
+        loops = 0
+        start = time.perf_counter()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                loops = 0
+                start = time.perf_counter()
+                continue
+            data = self.source.read()
+            if not data:
+                break
+            if self.previous_end is not None:
+                self.stats.gaps.append(time.perf_counter() - self.previous_end)
+                self.previous_end = None
+            if encode:
+                self.client.encode(data)
+            loops += 1
+            delay = start + FRAME_LENGTH * loops - time.perf_counter()
+            self.stats.frames += 1
+            if delay < -FRAME_LENGTH:
+                self.stats.late_frames += 1
+            time.sleep(max(0, delay))
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self):
+        return not self._end.is_set() and not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+
+class SimContext(commands.Context):
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class SimulatedBot(commands.Bot):
+    def __init__(self, simulation, config, loop):
+        super().__init__(command_prefix=config['prefix'], loop=loop)
+        self.config = config
+        self.logger = logging.getLogger('soak.bot')
+        self.simulation = simulation
+
+    @property
+    def user(self):
+        return self.simulation.bot_user
+
+    @property
+    def guilds(self):
+        return list(self.simulation.guilds.values())
+
+    @property
+    def voice_clients(self):
+        return [guild.voice_client for guild in self.simulation.guilds.values() if guild.voice_client is not None]
+
+    def get_guild(self, guild_id):
+        return self.simulation.guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        return self.simulation.channels.get(channel_id)
+
+    def get_user(self, user_id):
+        return self.simulation.members.get(user_id)
+
+    async def change_presence(self, *, activity=None, status=None, afk=False):
+        await self.simulation.api_call('presence')
+
+
+# Simulation
+
+class Simulation:
+    COMMANDS = ('play', 'skip', 'queue', 'remove')
+
+    def __init__(self, args, loop):
+        self.args = args
+        self.loop = loop
+        self.rng = random.Random(args.seed)
+        self.stats = Stats()
+        self.ids = itertools.count(10 ** 17)
+        self.bot_user = SimMember(next(self.ids), 'MusicBot', None)
+        self.guilds = {}
+        self.channels = {}
+        self.members = {}
+        self.encode = self._opus_available()
+        self.pending = set()
+        for _ in range(args.guilds):
+            self._add_guild()
+
+    @staticmethod
+    def _opus_available():
+        try:
+            discord.opus.Encoder()
+        except (discord.opus.OpusNotLoaded, OSError):
+            return False
+        return True
+
+    def _add_guild(self):
+        guild = SimGuild(next(self.ids), self)
+        for index in range(self.args.listeners):
+            roles = [guild.dj_role] if index < max(1, round(self.args.listeners * self.args.dj_fraction)) else []
+            member = SimMember(next(self.ids), 'user{}'.format(index), guild, roles)
+            member.voice = SimVoiceState(guild.voice_channel, self_deaf=self.rng.random() < self.args.deaf_fraction)
+            guild.voice_channel.members.append(member)
+            guild.members[member.id] = member
+            self.members[member.id] = member
+        self.guilds[guild.id] = guild
+        self.channels.update(guild.channels)
+
+    def config(self):
+        config = {}
+        if self.args.config:
+            with open(self.args.config) as config_file:
+                config.update(yaml.safe_load(config_file))
+        config.update({
+            'prefix': '*',
+            'voice_channel': {guild.id: [guild.voice_channel.id] for guild in self.guilds.values()},
+            'super_power_roles': ['DJs'],
+        })
+        config.setdefault('song_length', 1200)
+        config.setdefault('percentage_skip', 0.5)
+        # Keep every bit of state inside the scratch directory
+        config.setdefault('audio_cache', {})['directory'] = 'audio-cache'
+        config.setdefault('metadata_cache', {})['path'] = 'metadata-cache.sqlite3'
+        config['blacklist'] = {'snapshot': 'blacklist.json', 'journal': 'blacklist.journal'}
+        config.setdefault('queue_state', {})['directory'] = 'queue-state'
+        config['library'] = {'directories': []}
+        # The extractor stand-in only exists in this process
+        config.setdefault('extractor_pool', {})['processes'] = False
+        return ConfigSnapshot(config)
+
+    async def api_call(self, kind):
+        self.stats.api_calls[kind] += 1
+        await asyncio.sleep(self.args.api_latency)
+
+    async def on_command_error(self, ctx, error):
+        self.stats.errors[ctx.command.name if ctx.command else '?', type(error).__name__] += 1
+        if self.args.verbose:
+            logger.warning('%s failed in guild %s: %r', ctx.message.content, ctx.guild.id, error)
+
+    async def invoke(self, guild, author, content):
+        message = SimMessage(next(self.ids), content, author, guild.text_channel, self)
+        ctx = await self.bot.get_context(message, cls=SimContext)
+        name = content.split()[0][1:]
+        start = time.perf_counter()
+        try:
+            await self.bot.invoke(ctx)
+        except Exception:
+            pass # Unexpected errors are dispatched to on_command_error as well
+        self.stats.latencies[name].append(time.perf_counter() - start)
+        if ctx.command_failed:
+            self.stats.failures[name] += 1
+
+    def next_command(self, guild):
+        weights = (self.args.play_rate, self.args.skip_rate, self.args.queue_rate, self.args.remove_rate)
+        command = self.rng.choices(self.COMMANDS, weights)[0]
+        listeners = list(guild.members.values())
+        if command == 'play':
+            return self.rng.choice(listeners), '*play soak track {}'.format(self.rng.randrange(self.args.tracks * 4))
+        if command == 'remove':
+            djs = [member for member in listeners if len(member.roles) > 1]
+            state = self.cog.music_states.get(guild.id)
+            queued = state.playlist.qsize() if state else 0
+            return self.rng.choice(djs), '*remove {}'.format(self.rng.randint(1, queued + 1))
+        return self.rng.choice(listeners), '*{}'.format(command)
+
+    async def drive(self, guild, deadline):
+        rate = (self.args.play_rate + self.args.skip_rate + self.args.queue_rate + self.args.remove_rate) / 60
+        # Every guild starts by playing something, spread over the ramp up
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp_up))
+        author, content = self.rng.choice(list(guild.members.values())), '*play soak track {}'.format(self.rng.randrange(self.args.tracks * 4))
+        while self.loop.time() < deadline:
+            task = self.loop.create_task(self.invoke(guild, author, content))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            await asyncio.sleep(self.rng.expovariate(rate))
+            author, content = self.next_command(guild)
+
+    async def sample(self, started):
+        while True:
+            playing = sum(1 for guild in self.guilds.values() if guild.voice_client and guild.voice_client.is_playing())
+            self.stats.samples.append((time.perf_counter() - started, playing, resident_memory()))
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def run(self):
+        self.bot = SimulatedBot(self, self.config(), self.loop)
+        self.bot.add_listener(self.on_command_error, 'on_command_error')
+        # Not load_extension, that would import a second copy of the module without the extractor stand-in
+        music.setup(self.bot)
+        self.cog = self.bot.get_cog('Music')
+        self.bot._ready.set()
+        await self.cog.warmed_up.wait() # Keep the cache and queue loading out of the measurements
+
+        started = time.perf_counter()
+        cpu_start, children_start = time.process_time(), os.times()
+        sampler = self.loop.create_task(self.sample(started))
+        deadline = self.loop.time() + self.args.duration
+        await asyncio.gather(*(self.drive(guild, deadline) for guild in self.guilds.values()))
+
+        # Drain the commands still in flight, then stop playback so every FFmpeg process is reaped
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=self.args.drain_timeout)
+        sampler.cancel()
+        wall_time = time.perf_counter() - started
+        for state in list(self.cog.music_states.values()):
+            await state.stop()
+        self.bot.remove_cog('Music')
+        await asyncio.sleep(0.5)
+        children_end = os.times()
+        return {
+            'wall_time': wall_time,
+            'process_cpu': time.process_time() - cpu_start,
+            'ffmpeg_cpu': (children_end.children_user + children_end.children_system
+                           - children_start.children_user - children_start.children_system),
+        }
+
+    def report(self, timings):
+        stats = self.stats
+        stream_seconds = 0.0
+        previous = 0.0
+        for elapsed, playing, _ in stats.samples:
+            stream_seconds += playing * (elapsed - previous)
+            previous = elapsed
+        memory = [rss for _, _, rss in stats.samples]
+        total_cpu = timings['process_cpu'] + timings['ffmpeg_cpu']
+        return {
+            'settings': {key: value for key, value in vars(self.args).items() if key not in ('output',)},
+            'opus_encoding': self.encode,
+            'wall_time': timings['wall_time'],
+            'commands': {
+                name: dict(count=len(values), failed=stats.failures[name], **percentiles(values))
+                for name, values in sorted(stats.latencies.items())
+            },
+            'errors': {'{}: {}'.format(*key): count for key, count in stats.errors.most_common()},
+            'track_gaps': dict(count=len(stats.gaps), **percentiles(stats.gaps)),
+            'frames': {'sent': stats.frames, 'late': stats.late_frames},
+            'streams': {
+                'average': stream_seconds / previous if previous else 0.0,
+                'peak': max((playing for _, playing, _ in stats.samples), default=0),
+                'stream_seconds': stream_seconds,
+            },
+            'cpu': {
+                'process_seconds': timings['process_cpu'],
+                'ffmpeg_seconds': timings['ffmpeg_cpu'],
+                'cores_per_stream': total_cpu / stream_seconds if stream_seconds else None,
+                'process_cores_per_stream': timings['process_cpu'] / stream_seconds if stream_seconds else None,
+            },
+            'memory': {
+                'start': memory[0] if memory else None,
+                'end': memory[-1] if memory else None,
+                'peak': max(memory, default=None),
+                'growth': memory[-1] - memory[0] if memory else None,
+            },
+            'api_calls': dict(stats.api_calls),
+        }
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+
+def format_mb(size):
+    return '-' if size is None else '{:.1f} MB'.format(size / 2 ** 20)
+
+
+def print_report(report):
+    print('Simulated {guilds} guilds for {:.0f}s, {streams[average]:.1f} streams on average ({streams[peak]} peak)'.format(
+        report['wall_time'], streams=report['streams'], **report['settings']))
+    print()
+    print('{:<10} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('command', 'count', 'failed', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, result in report['commands'].items():
+        print('{:<10} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(name, result['count'], result['failed'], format_ms(result['p50']),
+                                                                  format_ms(result['p90']), format_ms(result['p99']), format_ms(result['max'])))
+    gaps = report['track_gaps']
+    print()
+    print('Track gaps: {} transitions, p50 {} ms, p90 {} ms, p99 {} ms, max {} ms'.format(
+        gaps['count'], format_ms(gaps['p50']), format_ms(gaps['p90']), format_ms(gaps['p99']), format_ms(gaps['max'])))
+    frames = report['frames']
+    print('Frames: {} sent, {} late ({:.2%}){}'.format(frames['sent'], frames['late'], frames['late'] / frames['sent'] if frames['sent'] else 0,
+                                                     '' if report['opus_encoding'] else ', Opus encoding not simulated (libopus not found)'))
+    cpu = report['cpu']
+    per_stream = cpu['cores_per_stream']
+    print('CPU: {:.1f}s bot process, {:.1f}s FFmpeg, {} of a core per stream ({} in the bot process)'.format(
+        cpu['process_seconds'], cpu['ffmpeg_seconds'], '-' if per_stream is None else '{:.2%}'.format(per_stream),
+        '-' if per_stream is None else '{:.2%}'.format(cpu['process_cores_per_stream'])))
+    memory = report['memory']
+    print('Memory: {} at start, {} at the end, {} peak, {} growth'.format(
+        format_mb(memory['start']), format_mb(memory['end']), format_mb(memory['peak']), format_mb(memory['growth'])))
+    print('API calls: {}'.format(', '.join('{} {}'.format(count, kind) for kind, count in sorted(report['api_calls'].items()))))
+    if report['errors']:
+        print('Command errors: {}'.format(', '.join('{} {}'.format(count, key) for key, count in report['errors'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load simulator for the music cog.')
+    parser.add_argument('--guilds', type=int, default=100, help='Simulated guilds (default: 100)')
+    parser.add_argument('--listeners', type=int, default=8, help='Members in the voice channel of every guild (default: 8)')
+    parser.add_argument('--duration', type=float, default=300, help='Seconds to issue commands for (default: 300)')
+    parser.add_argument('--ramp-up', type=float, default=30, help='Seconds over which the guilds start playing (default: 30)')
+    parser.add_argument('--play-rate', type=float, default=2, help='play commands per guild per minute (default: 2)')
+    parser.add_argument('--skip-rate', type=float, default=1, help='skip commands per guild per minute (default: 1)')
+    parser.add_argument('--queue-rate', type=float, default=1, help='queue commands per guild per minute (default: 1)')
+    parser.add_argument('--remove-rate', type=float, default=0.25, help='remove commands per guild per minute (default: 0.25)')
+    parser.add_argument('--tracks', type=int, default=50, help='Distinct tracks on the media server (default: 50)')
+    parser.add_argument('--min-length', type=float, default=20, help='Shortest track in seconds (default: 20)')
+    parser.add_argument('--max-length', type=float, default=90, help='Longest track in seconds (default: 90)')
+    parser.add_argument('--extract-latency', type=float, default=0.3, help='Seconds the media server takes per extraction (default: 0.3)')
+    parser.add_argument('--download-latency', type=float, default=0.5, help='Seconds the media server takes per download (default: 0.5)')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Seconds every simulated Discord API call takes (default: 0.05)')
+    parser.add_argument('--dj-fraction', type=float, default=0.25, help='Share of members with super powers (default: 0.25)')
+    parser.add_argument('--deaf-fraction', type=float, default=0.1, help='Share of deafened members (default: 0.1)')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between stream and memory samples (default: 1)')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='Seconds to wait for commands still running at the end (default: 60)')
+    parser.add_argument('--config', help='Bot config to simulate, e.g. config.yml. Paths in it are replaced by scratch ones')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory')
+    parser.add_argument('--output', help='Write the report to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='Log every failed command and the bot\'s own errors')
+    args = parser.parse_args()
+    if args.config:
+        args.config = os.path.abspath(args.config)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s:%(levelname)s:%(message)s')
+    logging.getLogger('discord').setLevel(logging.ERROR)
+    if not args.verbose:
+        logging.getLogger('soak.bot').setLevel(logging.CRITICAL)
+    if shutil.which('ffmpeg') is None:
+        sys.exit('FFmpeg is required to play the simulated tracks.')
+
+    scratch = tempfile.mkdtemp(prefix='musicbot-soak-')
+    original_directory = os.getcwd()
+    os.chdir(scratch)
+    server = None
+    try:
+        tracks = generate_tracks(os.path.join(scratch, 'media'), args.tracks, args.min_length, args.max_length, random.Random(args.seed))
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve_media, daemon=True,
+                                         args=(os.path.join(scratch, 'media'), tracks, args.extract_latency, args.download_latency, ready))
+        server.start()
+        music.SongInfo.ytdl = SimulatedYoutubeDL(ready.get(timeout=30))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        simulation = Simulation(args, loop)
+        report = simulation.report(loop.run_until_complete(simulation.run()))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        os.chdir(original_directory)
+        if args.keep:
+            print('Scratch directory kept at {}'.format(scratch))
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
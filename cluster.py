@@ -0,0 +1,127 @@
+'''
+Runs the bot as a cluster of worker processes, each running a slice of the shards with its own cogs.
+
+Workers share the audio cache, the metadata cache and the blacklist on disk. The supervisor
+restarts workers that die, backing off when they keep crashing.
+
+Usage: python cluster.py
+'''
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+import yaml
+
+GATEWAY_URL = 'https://discord.com/api/v7/gateway/bot'
+STABLE_AFTER = 60 # Seconds a worker has to run before its crash backoff resets
+MAX_RESTART_DELAY = 300
+
+logger = logging.getLogger('musicbot2.cluster')
+
+
+def split_shards(shard_count, workers):
+    '''Spreads the shard ids over the workers in contiguous blocks.'''
+    workers = max(1, min(workers, shard_count))
+    return [list(range(shard_count * worker // workers, shard_count * (worker + 1) // workers)) for worker in range(workers)]
+
+
+async def recommended_shard_count(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers={'Authorization': 'Bot ' + token}) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+
+def run_worker(worker_id, shard_ids, shard_count):
+    import main # Reads the config, so only import it in the worker
+    main.run(shard_ids=shard_ids, shard_count=shard_count, worker_id=worker_id)
+
+
+class Supervisor:
+    def __init__(self, shard_count, workers, identify_delay=5, restart_delay=5):
+        self.shard_count = shard_count
+        self.slices = split_shards(shard_count, workers)
+        self.identify_delay = identify_delay
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}
+        self.started_at = {}
+        self.failures = {}
+        self.start_at = {}
+        self.stopping = False
+
+    def start(self, worker_id):
+        shard_ids = self.slices[worker_id]
+        process = self.context.Process(target=run_worker, args=(worker_id, shard_ids, self.shard_count),
+                                       name='musicbot-worker-{}'.format(worker_id))
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.monotonic()
+        logger.info('Started worker %d (pid %d) for shards %s', worker_id, process.pid, shard_ids)
+
+    def check(self, worker_id):
+        process = self.processes.pop(worker_id)
+        uptime = time.monotonic() - self.started_at[worker_id]
+        self.failures[worker_id] = 0 if uptime >= STABLE_AFTER else self.failures.get(worker_id, 0) + 1
+        delay = min(self.restart_delay * 2 ** self.failures[worker_id], MAX_RESTART_DELAY)
+        logger.warning('Worker %d exited with code %s after %.0fs, restarting in %ds',
+                       worker_id, process.exitcode, uptime, delay)
+        self.start_at[worker_id] = time.monotonic() + delay
+
+    def run(self):
+        # Discord allows one shard login every identify_delay seconds, stagger the workers accordingly
+        delay = 0
+        for worker_id, shard_ids in enumerate(self.slices):
+            self.start_at[worker_id] = time.monotonic() + delay
+            delay += self.identify_delay * len(shard_ids)
+
+        while not self.stopping:
+            now = time.monotonic()
+            for worker_id, start_at in list(self.start_at.items()):
+                if start_at <= now and not self.stopping:
+                    del self.start_at[worker_id]
+                    self.start(worker_id)
+            for worker_id, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stopping:
+                    self.check(worker_id)
+            time.sleep(1)
+
+    def stop(self, *args):
+        self.stopping = True
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s:%(levelname)s:%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    config = yaml.safe_load(open('config.yml'))
+    secure = yaml.safe_load(open('secure.yml'))
+    cluster_config = config.get('cluster', {})
+
+    shard_count = cluster_config.get('shards')
+    if not shard_count:
+        shard_count = asyncio.get_event_loop().run_until_complete(recommended_shard_count(secure['token']))
+    workers = cluster_config.get('workers') or os.cpu_count() or 1
+    supervisor = Supervisor(shard_count, workers, identify_delay=cluster_config.get('identify_delay', 5),
+                            restart_delay=cluster_config.get('restart_delay', 5))
+    logger.info('Running %d shards in %d workers', shard_count, len(supervisor.slices))
+
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
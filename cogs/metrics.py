@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+import discord.ext.commands as commands
+
+from utils import metrics
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
+
+
+class Metrics(commands.Cog):
+    """Serves the metrics registry over HTTP in the Prometheus text format."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        metrics_config = bot.config.get('metrics', {})
+        self.interval = metrics_config.get('loop_lag_interval', 0.5)
+        # Cluster workers serve on consecutive ports
+        self.server = metrics.MetricsServer(host=metrics_config.get('host', '127.0.0.1'),
+                                            port=metrics_config.get('port', 9100) + (getattr(bot, 'worker_id', None) or 0))
+        self.loop_lag = metrics.Histogram('musicbot_event_loop_lag_seconds',
+                                          'How late event loop wakeups are past their deadline.', buckets=LAG_BUCKETS)
+        self.last_loop_lag = metrics.Gauge('musicbot_event_loop_lag_last_seconds', 'Most recent event loop lag sample.')
+        metrics.Gauge('musicbot_guilds', 'Guilds the bot is in.', callback=lambda: len(self.bot.guilds))
+        metrics.Gauge('musicbot_voice_clients', 'Connected voice clients.', callback=lambda: len(self.bot.voice_clients))
+        self.bot.loop.create_task(self.server.start())
+        self.lag_task = self.bot.loop.create_task(self.measure_loop_lag())
+
+    def cog_unload(self):
+        self.lag_task.cancel()
+        self.server.close()
+        for name in ('musicbot_event_loop_lag_seconds', 'musicbot_event_loop_lag_last_seconds',
+                     'musicbot_guilds', 'musicbot_voice_clients'):
+            metrics.REGISTRY.unregister(name)
+
+    async def measure_loop_lag(self):
+        while True:
+            deadline = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - deadline, 0.0)
+            self.loop_lag.observe(lag)
+            self.last_loop_lag.set(lag)
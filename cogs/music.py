@@ -1,17 +1,29 @@
 import asyncio
+import collections
 import functools
+import itertools
 import logging
 import os
 import pathlib
 import re
-import json
+import subprocess
+import threading
+import time
 import datetime
 
 import discord
 import discord.ext.commands as commands
 from yarl import URL
-import youtube_dl
 
+from utils import audionode, executor, loudness, metrics
+from utils.audiocache import AudioCache
+from utils.blackliststore import BlacklistStore
+from utils.filelock import file_lock
+from utils.library import LibraryIndex
+from utils.matcher import BlacklistMatcher
+from utils.metacache import MetadataCache
+from utils.outbound import OutboundScheduler
+from utils.queuestore import QueueStore
 from utils.superpowers import has_super_powers, not_check_has_super_powers
 
 # TODO: Settings deafen
@@ -21,6 +33,15 @@ def setup(bot):
     bot.add_cog(Music(bot))
 
 
+RESOLVE_TIME = metrics.Histogram('musicbot_resolve_seconds', 'Time spent resolving metadata with youtube_dl.', ['stage'])
+DOWNLOAD_TIME = metrics.Histogram('musicbot_download_seconds', 'Time spent downloading tracks.')
+FFMPEG_SPAWN_TIME = metrics.Histogram('musicbot_ffmpeg_spawn_seconds', 'Time spent spawning FFmpeg for a new source.', ['mode'])
+TRACK_GAP = metrics.Histogram('musicbot_track_gap_seconds', 'Time between the end of a track and the start of the next.')
+FIRST_AUDIO_TIME = metrics.Histogram('musicbot_time_to_first_audio_seconds', 'Time from a play command to audio starting.')
+
+DEFAULT_VOLUME = 0.5 # Opus mode transcodes at this level, so the default volume plays cached files untouched
+
+
 def duration_to_str(duration):
     # Extract minutes, hours and days
     minutes, seconds = divmod(duration, 60)
@@ -41,22 +62,317 @@ def duration_to_str(duration):
     return ', '.join(duration)
 
 
+class VoiceListeners:
+    """Ids of the members that can hear the bot, per voice channel, kept up to date from voice state events.
+
+    A channel is counted once when it is first asked for, and tracked until the bot leaves it.
+    """
+
+    def __init__(self):
+        self.channels = {} # channel id -> set of member ids
+
+    @staticmethod
+    def can_hear(member, voice):
+        return not member.bot and not voice.deaf and not voice.self_deaf
+
+    def members(self, channel):
+        members = self.channels.get(channel.id)
+        if members is None:
+            members = self.channels[channel.id] = {member.id for member in channel.members if self.can_hear(member, member.voice)}
+        return members
+
+    def count(self, channel):
+        return len(self.members(channel))
+
+    def update(self, member, before, after):
+        if before.channel is not None and before.channel.id in self.channels:
+            self.channels[before.channel.id].discard(member.id)
+        if after.channel is not None and after.channel.id in self.channels and self.can_hear(member, after):
+            self.channels[after.channel.id].add(member.id)
+
+    def forget(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+
 class MusicError(commands.UserInputError):
     pass
 
 
+# Extractor jobs, kept at module level so they can be pickled into a process pool
+
+def extract_sparse(request):
+    """Gets sparse info about a query, selecting the first valid entry of playlists."""
+    sparse_info = SongInfo.get_ytdl().extract_info(request, download=False, process=False)
+    if sparse_info is None or "entries" not in sparse_info:
+        return sparse_info
+    for entry in sparse_info['entries']:
+        if entry is not None:
+            return entry
+    return None
+
+
+def extract_full(url):
+    """Processes full video info, selecting the first search result if any."""
+    processed_info = SongInfo.get_ytdl().extract_info(url, download=False)
+    if processed_info is None or "entries" not in processed_info:
+        return processed_info
+    for entry in processed_info['entries']:
+        if entry is not None:
+            return entry
+    return None
+
+
+def extract_flat(url, limit):
+    """Reads the flat entry list of a playlist without resolving any of its entries."""
+    playlist = SongInfo.get_ytdl().extract_info(url, download=False, process=False)
+    if playlist is None or "entries" not in playlist:
+        return None
+    entries = (entry for entry in playlist['entries'] if entry is not None)
+    return [{
+        'url': entry.get('url') or entry.get('webpage_url') or entry.get('id'),
+        'id': entry.get('id'),
+        'title': entry.get('title'),
+    } for entry in itertools.islice(entries, limit)]
+
+
+def extract_download(url, filename, lock_path):
+    """Downloads a track, unless another process finished downloading it while we waited for the lock."""
+    with file_lock(lock_path):
+        if os.path.exists(filename):
+            return None
+        return SongInfo.get_ytdl().extract_info(url, download=True)
+
+
+def encode_opus(source, target, bitrate, gain=None):
+    """Encodes to Ogg Opus at the voice bitrate through a temporary file, so ``source`` may be ``target``."""
+    audio_filter = [] if gain is None else ['-af', 'volume={:.2f}dB'.format(gain)]
+    tmp_target = target + '.tmp'
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', source, '-vn', '-map_metadata', '-1'] + audio_filter +
+                   ['-c:a', 'libopus', '-b:a', '{}k'.format(bitrate), '-ar', '48000', '-ac', '2', '-f', 'opus', tmp_target],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.replace(tmp_target, target)
+
+
+def transcode_opus(source, target, bitrate, lock_path, level=DEFAULT_VOLUME):
+    """Transcodes a downloaded file to Ogg Opus at the voice bitrate and ``level``, replacing the original."""
+    with file_lock(lock_path):
+        if os.path.exists(target): # Transcoded by another process
+            return target
+        encode_opus(source, target, bitrate, loudness.factor_to_gain(level))
+        os.remove(source)
+    return target
+
+
+def normalize_opus(filename, target, bitrate, lock_path, marker_path, level=DEFAULT_VOLUME):
+    """Measures a cached Opus file and bakes its loudness correction in, so it can still be passed through.
+
+    Playing it with the correction would re-encode it on every play, this does it once in the background.
+    The file is kept at ``level`` of the target loudness, like the transcode does, and the gain still to
+    apply is returned. ``marker_path`` records the correction, measuring a corrected file again would add
+    the part ``loudness.MAX_GAIN`` cut off a second time.
+    """
+    remaining = -loudness.factor_to_gain(level)
+    with file_lock(lock_path):
+        if os.path.exists(marker_path): # Corrected by another process
+            return remaining
+        gain = loudness.measure_gain(filename, target)
+        if abs(gain - remaining) < OpusSong.NEGLIGIBLE_GAIN:
+            return gain
+        encode_opus(filename, filename, bitrate, gain - remaining)
+        open(marker_path, 'w').close()
+    return remaining
+
+
 class Song(discord.PCMVolumeTransformer):
-    def __init__(self, song_info):
+    STREAM_BEFORE_OPTIONS = '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+    def __init__(self, song_info, stream=False, volume=1.0, start=0):
+        self.info = song_info.info
+        self.requester = song_info.requester
+        self.channel = song_info.channel
+        self.filename = song_info.filename
+        self.streamed = stream
+        self.playing_string = str(song_info) #hacky fix
+        # Loudness correction is applied by FFmpeg, it costs nothing per frame in Python
+        options = '-vn' if song_info.correction is None else '-vn -af volume={:.2f}dB'.format(song_info.correction)
+        seek = ' -ss {:.2f}'.format(start) if start else ''
+        if stream:
+            # Play straight from the media URL while the download fills the cache
+            source = discord.FFmpegPCMAudio(song_info.stream_url, before_options=self.STREAM_BEFORE_OPTIONS + seek, options=options)
+        else:
+            source = discord.FFmpegPCMAudio(self.filename, before_options='-nostdin' + seek, options=options)
+        super().__init__(source, volume=volume)
+
+    def __str__(self):
+        return self.playing_string #hacky fix
+
+
+class OpusSong(discord.AudioSource):
+    """Plays Opus packets straight out of FFmpeg, without any per-frame work in Python.
+
+    Volume is applied by FFmpeg, so changing it respawns FFmpeg from the current position.
+    Cached Opus files at the default volume are passed through without re-encoding. They are
+    transcoded at that level and the background analysis bakes their loudness correction in.
+    """
+    FRAME_LENGTH = 0.02 # Seconds of audio per Opus packet
+    NEGLIGIBLE_GAIN = 0.5 # dB, smaller level differences are inaudible and not worth re-encoding for
+
+    def __init__(self, song_info, stream=False, volume=1.0, bitrate=96, start=0):
+        self.info = song_info.info
+        self.requester = song_info.requester
+        self.channel = song_info.channel
+        self.filename = song_info.filename
+        self.streamed = stream
+        self.playing_string = str(song_info) #hacky fix
+        self.location = song_info.stream_url if stream else self.filename
+        self.bitrate = bitrate
+        correction = song_info.correction
+        self.gain_factor = 1.0 if correction is None else loudness.gain_to_factor(correction)
+        self.frames = int(start / self.FRAME_LENGTH)
+        self._volume = volume
+        self._lock = threading.Lock()
+        self._source = self._spawn(self.position)
+
+    def _spawn(self, position):
+        before_options = Song.STREAM_BEFORE_OPTIONS if self.streamed else '-nostdin'
+        if position:
+            before_options += ' -ss {:.2f}'.format(position)
+        factor = self._volume * self.gain_factor
+        if self.location.endswith('.opus') and factor > 0 and abs(loudness.factor_to_gain(factor)) < self.NEGLIGIBLE_GAIN:
+            return discord.FFmpegOpusAudio(self.location, codec='copy', before_options=before_options, options='-vn')
+        return discord.FFmpegOpusAudio(self.location, bitrate=self.bitrate, before_options=before_options,
+                                       options='-vn -af volume={:.3f}'.format(factor))
+
+    @property
+    def position(self):
+        return self.frames * self.FRAME_LENGTH
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        """Respawns FFmpeg, which blocks, set it from an executor."""
+        value = max(value, 0.0)
+        with self._lock:
+            if value == self._volume:
+                return
+            self._volume = value
+            old_source = self._source
+            self._source = self._spawn(self.position)
+        old_source.cleanup()
+
+    def read(self):
+        with self._lock:
+            data = self._source.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._source.cleanup()
+
+    def __str__(self):
+        return self.playing_string #hacky fix
+
+
+class NodeSong(discord.AudioSource):
+    """Plays Opus packets decoded, mixed and encoded by an audio node process.
+
+    The next packet is always requested ahead, so reading one only costs the player
+    thread a receive on a local socket. Volume changes and seeks apply immediately.
+    """
+    FRAME_LENGTH = audionode.FRAME_LENGTH
+
+    def __init__(self, song_info, node_pool, stream=False, volume=1.0, bitrate=96, start=0):
         self.info = song_info.info
         self.requester = song_info.requester
         self.channel = song_info.channel
         self.filename = song_info.filename
+        self.streamed = stream
         self.playing_string = str(song_info) #hacky fix
-        super().__init__(discord.FFmpegPCMAudio(self.filename, before_options='-nostdin', options='-vn'))
+        self.frames = int(start / self.FRAME_LENGTH)
+        self._volume = volume
+        self._lock = threading.Lock()
+        self.node_pool = node_pool
+        self.node, self._conn = node_pool.open()
+        options = '-vn' if song_info.correction is None else '-vn -af volume={:.2f}dB'.format(song_info.correction)
+        try:
+            self._send('play', {
+                'location': song_info.stream_url if stream else self.filename,
+                'before_options': Song.STREAM_BEFORE_OPTIONS if stream else '-nostdin',
+                'options': options,
+                'volume': volume,
+                'bitrate': bitrate,
+                'start': start,
+            })
+            error = self._conn.recv()
+            if error is not None:
+                raise discord.ClientException('Audio node could not play {}: {}'.format(self.playing_string, error))
+            self._send('read')
+        except Exception:
+            self.cleanup()
+            raise
+
+    def _send(self, *command):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.send(command)
+
+    @property
+    def position(self):
+        return self.frames * self.FRAME_LENGTH
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        self._send('volume', self._volume)
+
+    def seek(self, position):
+        self._send('seek', position)
+        self.frames = int(position / self.FRAME_LENGTH)
+
+    def read(self):
+        conn = self._conn
+        if conn is None:
+            return b''
+        try:
+            data = conn.recv_bytes()
+            if data:
+                self._send('read')
+        except (EOFError, OSError):
+            return b'' # The node died, end the track
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            conn, self._conn = self._conn, None
+        try:
+            conn.send(('close',))
+        except (EOFError, OSError):
+            pass
+        conn.close()
+        self.node_pool.release(self.node)
 
     def __str__(self):
         return self.playing_string #hacky fix
 
+
 class SongInfo:
     ytdl_opts = {
         'default_search': 'auto',
@@ -69,18 +385,41 @@ class SongInfo:
         'logtostderr': False,
         'no_warnings': True,
         'quiet': True,
-        'outtmpl': 'audio-cache/%(extractor)s-%(id)s-%(title)s.%(ext)s',
+        'outtmpl': 'audio-cache/%(extractor)s-%(id)s.%(ext)s',
         'noplaylist': True
     }
-    ytdl = youtube_dl.YoutubeDL(ytdl_opts)
+    ytdl = None # YoutubeDL, created on first use
+    audio_cache = None # Shared AudioCache, set up by the Music cog
+    metadata_cache = None # Shared MetadataCache, set up by the Music cog
+    pool = None # Shared ExtractorPool, set up by the Music cog
+    library = None # LibraryIndex of local music, set up by the Music cog when configured
+    opus_bitrate = None # Transcode downloads to Opus at this bitrate (kbps) when set
+    audio_nodes = None # AudioNodePool playing the tracks out of process, set up by the Music cog when configured
+    loudness_target = None # Analyse downloads and normalize them to this loudness (LUFS) when set
+    analysing = {} # cache key -> loudness analysis task, a track queued in several places is measured once
+    LOCAL_PREFIX = 'local:'
+    persisted_info_keys = ('_filename', 'extractor', 'extractor_key', 'id', 'ext', 'title', 'uploader', 'creator',
+                           'duration', 'webpage_url')
+
+    @classmethod
+    def get_ytdl(cls):
+        if cls.ytdl is None:
+            import youtube_dl # Slow to import, keep it off the startup path
+            cls.ytdl = youtube_dl.YoutubeDL(cls.ytdl_opts)
+        return cls.ytdl
 
     def __init__(self, info, requester, channel):
-        self.info = info
         self.requester = requester
         self.channel = channel
-        self.filename = info.get('_filename', self.ytdl.prepare_filename(self.info))
         self.downloaded = asyncio.Event()
         self.local_file = '_filename' in info
+        self.resolved = '_placeholder' not in info
+        self.set_info(info)
+        self.pinned = False
+        self._resolve_task = None
+        self.error = None
+        self.handle = None # Set by the playlist
+        self.start = 0 # Offset to resume playback from, in seconds
 
     @classmethod
     async def create(cls, query, requester, channel, loop=None):
@@ -91,6 +430,21 @@ class SongInfo:
         except OSError:
             pass
 
+        loop = loop or asyncio.get_event_loop()
+        # Local files are only picked for "local:" queries, or instead of a search when the library is preferred
+        if query.startswith(cls.LOCAL_PREFIX):
+            if cls.library is None:
+                raise MusicError('No local music library is configured.')
+            query = query[len(cls.LOCAL_PREFIX):].strip()
+            match = await loop.run_in_executor(None, cls.library.best_match, query)
+            if match is None:
+                raise MusicError('No local file matches {}'.format(query))
+            return cls.from_library(*match, requester, channel)
+        if cls.library is not None and cls.library.prefer_local and not query.startswith(('http://', 'https://')):
+            match = await loop.run_in_executor(None, cls.library.best_match, query)
+            if match is not None:
+                return cls.from_library(*match, requester, channel)
+
         return await cls.from_ytdl(query, requester, channel, loop=loop)
 
     @classmethod
@@ -99,6 +453,9 @@ class SongInfo:
         if not path.exists():
             raise MusicError('File {} not found.'.format(file))
 
+        if cls.library is not None and file in cls.library.entries:
+            return cls.from_library(file, cls.library.entries[file], requester, channel)
+
         info = {
             '_filename': file,
             'title': path.stem,
@@ -106,179 +463,856 @@ class SongInfo:
         }
         return cls(info, requester, channel)
 
+    @classmethod
+    def from_library(cls, path, entry, requester, channel):
+        info = {
+            '_filename': path,
+            'title': entry['title'],
+            'creator': entry.get('artist') or 'local file',
+        }
+        if entry.get('duration') is not None:
+            info['duration'] = entry['duration']
+        return cls(info, requester, channel)
+
+    def set_info(self, info):
+        self.info = info
+        if self.resolved:
+            self.filename = info.get('_filename', self.get_ytdl().prepare_filename(self.info))
+            self.cache_key = None if self.local_file else AudioCache.key_for(self.filename)
+        else:
+            self.filename = None
+            self.cache_key = None
+
+    @classmethod
+    def placeholder(cls, entry, requester, channel):
+        """Creates a lightweight, unresolved entry from a flat playlist entry."""
+        info = {
+            '_placeholder': True,
+            'url': entry['url'],
+            'id': entry.get('id'),
+            'title': entry.get('title') or entry['url'],
+        }
+        return cls(info, requester, channel)
+
+    def resolve(self, loop, priority=executor.PREFETCH):
+        """Fetches full metadata for placeholders. Concurrent callers share one resolution."""
+        if self._resolve_task is None:
+            self._resolve_task = loop.create_task(self._resolve(loop, priority))
+        return asyncio.shield(self._resolve_task)
+
+    async def _resolve(self, loop, priority):
+        if self.resolved:
+            return
+        url = self.info['url']
+        info = await self.cached_metadata(loop, 'full', url)
+        if info is None:
+            guild_id = self.channel.guild.id if getattr(self.channel, 'guild', None) else None
+            info = await self.pool.run(priority, extract_full, url, guild_id=guild_id)
+            if info is None:
+                raise MusicError('Could not retrieve info from url : {}'.format(url))
+            await self.store_metadata(loop, 'full', url, info)
+        self.resolved = True
+        self.set_info(info)
+
+    @classmethod
+    def from_entry(cls, entry, bot, guild):
+        """Rebuilds a SongInfo from a persisted queue entry without calling the extractor."""
+        requester = guild.get_member(entry['requester']) or bot.get_user(entry['requester'])
+        channel = bot.get_channel(entry['channel'])
+        if requester is None or channel is None:
+            return None
+        return cls(entry['info'], requester, channel)
+
+    def to_entry(self):
+        keys = self.persisted_info_keys if self.resolved else ('_placeholder', 'url', 'id', 'title')
+        return {
+            'info': {key: self.info[key] for key in keys if key in self.info},
+            'requester': self.requester.id,
+            'channel': self.channel.id,
+        }
+
     @classmethod
     async def from_ytdl(cls, request, requester, channel, loop=None):
         loop = loop or asyncio.get_event_loop()
 
-        # Get sparse info about our query
-        partial = functools.partial(cls.ytdl.extract_info, request, download=False, process=False)
-        sparse_info = await loop.run_in_executor(None, partial)
-
-        if sparse_info is None:
-            raise MusicError('Could not retrieve info from input : {}'.format(request))
+        guild_id = channel.guild.id if getattr(channel, 'guild', None) else None
 
-        # If we get a playlist, select its first valid entry
-        if "entries" not in sparse_info:
-            info_to_process = sparse_info
-        else:
-            info_to_process = None
-            for entry in sparse_info['entries']:
-                if entry is not None:
-                    info_to_process = entry
-                    break
+        # Get sparse info about our query
+        info_to_process = await cls.cached_metadata(loop, 'sparse', request)
+        if info_to_process is None:
+            with RESOLVE_TIME.time('sparse'):
+                info_to_process = await cls.pool.run(executor.INTERACTIVE, extract_sparse, request, guild_id=guild_id)
             if info_to_process is None:
                 raise MusicError('Could not retrieve info from input : {}'.format(request))
+            await cls.store_metadata(loop, 'sparse', request, info_to_process)
 
         # Process full video info
         url = info_to_process.get('url', info_to_process.get('webpage_url', info_to_process.get('id')))
-        partial = functools.partial(cls.ytdl.extract_info, url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        info = await cls.cached_metadata(loop, 'full', url)
+        if info is None:
+            with RESOLVE_TIME.time('full'):
+                info = await cls.pool.run(executor.INTERACTIVE, extract_full, url, guild_id=guild_id)
+            if info is None:
+                raise MusicError('Could not retrieve info from url : {}'.format(url))
+            await cls.store_metadata(loop, 'full', url, info)
 
-        if processed_info is None:
-            raise MusicError('Could not retrieve info from input : {}'.format(request))
+        return cls(info, requester, channel)
 
-        # Select the first search result if any
-        if "entries" not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise MusicError('Could not retrieve info from url : {}'.format(info_to_process["url"]))
+    @classmethod
+    async def cached_metadata(cls, loop, kind, query):
+        if cls.metadata_cache is None:
+            return None
+        return await loop.run_in_executor(None, cls.metadata_cache.get, kind, query)
 
-        return cls(info, requester, channel)
+    @classmethod
+    async def store_metadata(cls, loop, kind, query, info):
+        if cls.metadata_cache is None:
+            return
+        try:
+            await loop.run_in_executor(None, cls.metadata_cache.put, kind, query, info)
+        except Exception:
+            logging.getLogger(__name__).exception('Could not cache metadata for %s', query)
+
+    async def download(self, loop, priority=executor.PREFETCH):
+        if self.local_file:
+            self.downloaded.set()
+            return
+        if not self.resolved:
+            await self.resolve(loop, priority)
+
+        # Pin the file so it can't be evicted while it is queued or playing
+        if not self.pinned:
+            self.pinned = True
+            await self.audio_cache.acquire(self.cache_key)
+
+        cached = self.audio_cache.lookup(self.cache_key)
+        if cached is not None:
+            self.filename = cached
+        else:
+            # Cancelling a prefetch drops its job while it is queued. Once the job runs it is left to finish
+            # in the background, so the file it writes is still registered with the cache and its budget.
+            started = asyncio.Event()
+            fetch = loop.create_task(self.fetch_file(loop, priority, started))
+            try:
+                await asyncio.shield(fetch)
+            except asyncio.CancelledError:
+                if not started.is_set():
+                    fetch.cancel()
+                raise
+        if self.loudness_target is not None and self.gain is None and self.cache_key not in self.analysing:
+            task = self.analysing[self.cache_key] = loop.create_task(self.analyse_loudness(loop))
+            task.add_done_callback(lambda _, key=self.cache_key: self.analysing.pop(key, None))
+        self.downloaded.set()
 
-    async def download(self, loop):
+    async def fetch_file(self, loop, priority, started):
+        """Downloads (and transcodes) the track and adds it to the cache. ``started`` is set once a pool job runs."""
+        lock_path = self.audio_cache.lock_path(self.cache_key, 'download')
         if not pathlib.Path(self.filename).exists():
-            partial = functools.partial(self.ytdl.extract_info, self.info['webpage_url'], download=True)
-            self.info = await loop.run_in_executor(None, partial)
-        self.downloaded.set()
+            guild_id = self.channel.guild.id if getattr(self.channel, 'guild', None) else None
+            with DOWNLOAD_TIME.time():
+                info = await self.pool.run(priority, extract_download, self.info['webpage_url'], self.filename, lock_path,
+                                           guild_id=guild_id, started=started)
+            if info is not None:
+                self.info = info
+        level = None
+        if self.opus_bitrate and not self.filename.endswith('.opus'):
+            target = os.path.splitext(self.filename)[0] + '.opus'
+            try:
+                self.filename = await self.pool.run(priority, transcode_opus, self.filename, target, self.opus_bitrate, lock_path,
+                                                    started=started)
+                level = DEFAULT_VOLUME
+            except (OSError, subprocess.CalledProcessError):
+                logging.getLogger(__name__).exception('Could not transcode %s, keeping the original', self.filename)
+        self.audio_cache.add(self.cache_key, self.filename)
+        if level is not None:
+            self.audio_cache.set_level(self.cache_key, level)
+        loop.create_task(self.audio_cache.maintain(loop))
+
+    async def analyse_loudness(self, loop):
+        """Measures the cached file once and stores its loudness correction with the cache entry.
+
+        Runs after the file is ready, so it never delays the start of playback. Opus files get the
+        correction baked in, they are passed through untouched afterwards.
+        """
+        baked = self.opus_bitrate and self.filename.endswith('.opus')
+        try:
+            if baked:
+                gain = await self.pool.run(executor.PREFETCH, normalize_opus, self.filename, self.loudness_target, self.opus_bitrate,
+                                           self.audio_cache.lock_path(self.cache_key, 'download'),
+                                           self.audio_cache.lock_path(self.cache_key, 'normalized'))
+            else:
+                gain = await self.pool.run(executor.PREFETCH, loudness.measure_gain, self.filename, self.loudness_target)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            logging.getLogger(__name__).exception('Could not analyse loudness of %s', self.filename)
+            return
+        if baked:
+            self.audio_cache.add(self.cache_key, self.filename) # The size changed
+        self.audio_cache.set_gain(self.cache_key, gain)
+        await self.audio_cache.maintain(loop)
+
+    @property
+    def gain(self):
+        """Loudness correction in dB, None until the file has been analysed."""
+        if self.local_file:
+            return None
+        return self.audio_cache.get_gain(self.cache_key)
+
+    @property
+    def correction(self):
+        """Gain in dB to play the file with, None if it plays as is.
+
+        Until the file is analysed this only undoes the level it was transcoded at.
+        """
+        gain = self.gain
+        if gain is not None or self.local_file:
+            return gain
+        level = self.audio_cache.get_level(self.cache_key)
+        return None if level == 1.0 else -loudness.factor_to_gain(level)
+
+    @property
+    def stream_url(self):
+        """Direct media URL of the selected format, if the extractor provided one."""
+        if self.local_file:
+            return None
+        return self.info.get('url')
+
+    def can_stream(self):
+        return self.resolved and not self.downloaded.is_set() and self.stream_url is not None
+
+    def release(self):
+        """Unpins the cached file, making it eligible for eviction again."""
+        if self.pinned:
+            self.audio_cache.release(self.cache_key)
+            self.pinned = False
 
     async def wait_until_downloaded(self):
         await self.downloaded.wait()
 
     def __str__(self):
         title = "`{}`".format(self.info['title'])
-        creator = "`{}`".format(self.info.get('creator') or self.info['uploader'])
+        creator = "`{}`".format(self.info.get('creator') or self.info.get('uploader') or 'unknown')
         duration = " (duration: {})".format(duration_to_str(self.info['duration'])) if 'duration' in self.info else ''
         requester = "`{}`".format(self.requester)
         return '{} from {}{} added by {}'.format(title, creator, duration, requester)
 
 
-class Playlist(asyncio.Queue):
+class Playlist:
+    """Queue of SongInfo entries built for long playlists.
+
+    Every entry gets a stable handle when it is added and removal by handle is O(1).
+    Memoized display lines keep the queue command cheap regardless of the playlist length.
+    Queued files are protected through their audio cache pins, not tracked here.
+    """
+    MAX_RENDER_LENGTH = 1955
+
+    def __init__(self, maxsize=50):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict() # handle -> SongInfo
+        self._lines = {} # handle -> memoized str(song)
+        self._handles = itertools.count()
+        self._rendered = None
+
     def __iter__(self):
-        return self._queue.__iter__()
+        return iter(self._entries.values())
 
-    def clear(self):
-        for song in self._queue:
-            try:
-                os.remove(song.filename)
-            except:
-                pass
-        self._queue.clear()
+    def __len__(self):
+        return len(self._entries)
 
-    def get_song(self):
-        return self.get_nowait()
+    def qsize(self):
+        return len(self._entries)
+
+    def empty(self):
+        return not self._entries
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._entries)
+
+    def free_slots(self):
+        """How many more songs fit, None if the playlist size is unlimited."""
+        if self.maxsize <= 0:
+            return None
+        return max(self.maxsize - len(self._entries), 0)
 
     def add_song(self, song):
-        self.put_nowait(song)
+        """Appends a song and returns its handle."""
+        if self.full():
+            raise asyncio.QueueFull
+        handle = next(self._handles)
+        song.handle = handle
+        self._entries[handle] = song
+        self._rendered = None
+        return handle
+
+    def _forget(self, handle):
+        self._lines.pop(handle, None)
+        self._rendered = None
+
+    def get_song(self):
+        if not self._entries:
+            raise asyncio.QueueEmpty
+        handle, song = self._entries.popitem(last=False)
+        self._forget(handle)
+        return song
+
+    def take(self, handle):
+        """Pops an entry by handle without releasing it, like get_song does for the first one."""
+        song = self._entries.pop(handle, None)
+        if song is not None:
+            self._forget(handle)
+        return song
+
+    def items(self):
+        return self._entries.items()
+
+    def handle_at(self, idx):
+        if idx < 0:
+            raise IndexError('playlist index out of range')
+        handle = next(itertools.islice(self._entries, idx, None), None)
+        if handle is None:
+            raise IndexError('playlist index out of range')
+        return handle
+
+    def remove(self, handle):
+        song = self._entries.pop(handle)
+        self._forget(handle)
+        song.release()
+        return song
 
     def delete_song(self, idx):
-        del self._queue[idx]
+        return self.remove(self.handle_at(idx))
+
+    def clear(self):
+        for song in self._entries.values():
+            song.release()
+        self._entries.clear()
+        self._lines.clear()
+        self._rendered = None
+
+    def refresh(self, song):
+        """Updates the memoized data of an entry whose info changed, e.g. once it got resolved."""
+        if self._entries.get(song.handle) is not song:
+            return
+        self._lines.pop(song.handle, None)
+        self._rendered = None
 
     def __str__(self):
-        info = 'Current playlist:\n'
-        info_len = len(info)
-        highest_idx = 0
-        for idx, song in enumerate(self, 1):
-            highest_idx = idx
-            s = '{}. {}'.format(idx, str(song))
-            l = len(s) + 1 # Counting the extra \n
-            if info_len + l > 1955:
-                info += '[...]'
+        if self._rendered is None:
+            self._rendered = self._render()
+        return self._rendered
+
+    def _render(self):
+        header = 'Current playlist:\n'
+        parts = [header]
+        length = len(header)
+        for idx, (handle, song) in enumerate(self._entries.items(), 1):
+            line = self._lines.get(handle)
+            if line is None:
+                line = self._lines[handle] = str(song)
+            s = '{}. {}\n'.format(idx, line)
+            if length + len(s) > self.MAX_RENDER_LENGTH:
+                parts.append('[...]\n')
                 break
-            info += '{}\n'.format(s)
-            info_len += l
-        info += 'Total songs in playlist: {}\n'.format(highest_idx)
-        return info
+            parts.append(s)
+            length += len(s)
+        parts.append('Total songs in playlist: {}\n'.format(len(self._entries)))
+        return ''.join(parts)
+
+
+class Prefetcher:
+    """Keeps only the first ``window`` playlist entries downloading.
+
+    The window is refilled as songs are consumed and downloads of entries that get
+    removed from the playlist are cancelled. Unresolved placeholders in the
+    ``resolve_ahead`` entries past the window get their metadata resolved early,
+    and are checked with ``check`` before they are downloaded.
+    """
+
+    def __init__(self, playlist, loop, window=3, resolve_ahead=5):
+        self.playlist = playlist
+        self.loop = loop
+        self.window = window
+        self.resolve_ahead = resolve_ahead
+        self.check = None # Coroutine raising MusicError for songs that may not be played
+        self.tasks = {} # SongInfo -> download task
+        self.resolving = {} # SongInfo -> resolve task
+
+    def fetch(self, song, priority=executor.PREFETCH):
+        if song.downloaded.is_set() or song in self.tasks:
+            return
+        task = self.loop.create_task(self._fetch(song, priority))
+        task.add_done_callback(functools.partial(self._download_done, song))
+        self.tasks[song] = task
+
+    async def _fetch(self, song, priority):
+        if not song.resolved:
+            await self._resolve(song, priority)
+        await song.download(self.loop, priority=priority)
+
+    async def _resolve(self, song, priority):
+        await song.resolve(self.loop, priority)
+        self.playlist.refresh(song)
+        if self.check is not None:
+            await self.check(song)
+
+    def _resolve_done(self, song, task):
+        self.resolving.pop(song, None)
+        if not task.cancelled() and task.exception() is not None:
+            song.error = task.exception()
+            song.downloaded.set()
+
+    def _download_done(self, song, task):
+        self.tasks.pop(song, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            # Unblock whoever waits on this song, play_next_song will skip it
+            song.error = task.exception()
+            song.downloaded.set()
+
+    def refill(self):
+        upcoming = itertools.islice(self.playlist, self.window + self.resolve_ahead)
+        for position, song in enumerate(upcoming):
+            if position < self.window:
+                self.fetch(song, executor.NEXT_UP if position == 0 else executor.PREFETCH)
+            elif not song.resolved and song not in self.resolving and not song.downloaded.is_set():
+                task = self.loop.create_task(self._resolve(song, executor.PREFETCH))
+                task.add_done_callback(functools.partial(self._resolve_done, song))
+                self.resolving[song] = task
+
+    def cancel(self, song):
+        for tasks in (self.tasks, self.resolving):
+            task = tasks.pop(song, None)
+            if task is not None:
+                task.cancel()
+
+    def cancel_all(self):
+        for tasks in (self.tasks, self.resolving):
+            for task in tasks.values():
+                task.cancel()
+            tasks.clear()
+
+    def status(self):
+        return {
+            'window': self.window,
+            'in_flight': len(self.tasks),
+            'resolving': len(self.resolving),
+            'ready': sum(1 for song in itertools.islice(self.playlist, self.window) if song.downloaded.is_set()),
+            'queued': self.playlist.qsize(),
+        }
 
 
 class GuildMusicState:
-    def __init__(self, bot):
+    def __init__(self, bot, guild_id=None, queue_store=None):
         self.bot = bot
-        self.playlist = Playlist(maxsize=50)
+        self.guild_id = guild_id
+        self.queue_store = queue_store
+        self.playlist = Playlist(maxsize=bot.config.get('playlist_size', 50))
+        self.prefetcher = Prefetcher(self.playlist, bot.loop, window=bot.config.get('prefetch_window', 3),
+                                     resolve_ahead=bot.config.get('resolve_ahead', 5))
+        self.streaming = bot.config.get('streaming', False)
+        self.audio_mode = bot.config.get('audio_mode', 'pcm')
         self.voice_client = None
         self.loop = bot.loop
-        self.player_volume = 0.5
+        self.player_volume = DEFAULT_VOLUME
         self.skips = set()
-        self.min_skips = 5
+        self._min_skips = 5
+        self.start_offset = 0
+        self.started_playing_at = None
         self.previous_queuer = discord.Object(bot.user.id) # Bot cannot add tracks, making it a save initialization choice
+        self.prewarm = bot.config.get('prewarm', 5)
+        self.prepared = None # (song info, streamed, source) of the next track, spawned ahead of time
+        self.prepare_task = None
+        self.advancing = False # Set while a new track is being started, so commands don't start a second one
+        self.outbound = None # OutboundScheduler of the Music cog
+        self.handing_over = None # Entry the player thread started, until swapped takes it out of the playlist
+        self._prepared_lock = threading.Lock() # Guards prepared and handing_over, the player thread takes the prepared source
 
     @property
     def current_song(self):
-        return self.voice_client.source
+        return self.voice_client.source if self.voice_client else None
 
     @property
     def volume(self):
         return self.player_volume
 
-    @volume.setter
-    def volume(self, value):
+    async def set_volume(self, value):
+        """Changes the volume of the playing and the prepared track.
+
+        Opus sources respawn FFmpeg for it, so this runs in an executor like creating a source does.
+        """
         self.player_volume = value
-        if self.voice_client:
-            self.voice_client.source.volume = value
+        self.record('settings', {'volume': value})
+        sources = [self.voice_client.source] if self.voice_client and self.voice_client.source else []
+        prepared = self.prepared
+        if prepared is not None:
+            sources.append(prepared[2])
+        await self.loop.run_in_executor(None, self.apply_volume, sources, value)
+
+    @staticmethod
+    def apply_volume(sources, value):
+        for source in sources:
+            source.volume = value
 
-    async def stop(self):
+    @property
+    def min_skips(self):
+        return self._min_skips
+
+    @min_skips.setter
+    def min_skips(self, value):
+        self._min_skips = value
+        self.record('settings', {'min_skips': value})
+
+    @property
+    def position(self):
+        """Seconds into the current track."""
+        if self.started_playing_at is None:
+            return self.start_offset
+        return (datetime.datetime.now() - self.started_playing_at).total_seconds() + self.start_offset
+
+    def record(self, *event):
+        if self.queue_store is not None:
+            self.queue_store.record(self.guild_id, *event)
+
+    def snapshot(self):
+        return {
+            'voice_channel': self.voice_client.channel.id if self.voice_client else None,
+            'volume': self.player_volume,
+            'min_skips': self._min_skips,
+            'current': None,
+            'position': 0.0,
+            'queue': [[handle, song.to_entry()] for handle, song in self.playlist.items()],
+        }
+
+    async def restore(self, saved):
+        """Rebuilds a persisted queue, reconnects and continues from the saved offset."""
+        guild = self.bot.get_guild(self.guild_id)
+        if saved['volume'] is not None:
+            self.player_volume = saved['volume']
+        if saved['min_skips'] is not None:
+            self._min_skips = saved['min_skips']
+
+        if saved['current'] is not None:
+            current = SongInfo.from_entry(saved['current'], self.bot, guild)
+            if current is not None:
+                current.start = saved['position']
+                self.playlist.add_song(current)
+        for _, entry in saved['queue']:
+            song = SongInfo.from_entry(entry, self.bot, guild)
+            if song is None:
+                continue
+            try:
+                self.playlist.add_song(song)
+            except asyncio.QueueFull:
+                break
+        # Playlist handles start over after a restart
+        self.queue_store.reset(self.guild_id, self.snapshot())
+
+        channel = guild.get_channel(saved['voice_channel']) if saved['voice_channel'] else None
+        if channel is None or self.playlist.empty():
+            return
+        self.voice_client = await channel.connect()
+        await self.play_next_song()
+
+    def create_source(self, song_info, stream=False):
+        if SongInfo.audio_nodes is not None:
+            return NodeSong(song_info, SongInfo.audio_nodes, stream=stream, volume=self.player_volume,
+                            bitrate=self.bot.config.get('opus_bitrate', 96), start=song_info.start)
+        if self.audio_mode == 'opus':
+            return OpusSong(song_info, stream=stream, volume=self.player_volume, bitrate=SongInfo.opus_bitrate, start=song_info.start)
+        return Song(song_info, stream=stream, volume=self.player_volume, start=song_info.start)
+
+    def apply_config(self, config):
+        """Picks up the settings that can change while the bot runs."""
+        self.playlist.maxsize = config.playlist_size
+        self.prefetcher.window = config.get('prefetch_window', 3)
+        self.prefetcher.resolve_ahead = config.get('resolve_ahead', 5)
+        self.streaming = config.get('streaming', False)
+        self.prewarm = config.get('prewarm', 5)
+        self.prefetcher.refill()
+
+    def create_timed_source(self, song_info, stream):
+        with FFMPEG_SPAWN_TIME.time('node' if SongInfo.audio_nodes is not None else self.audio_mode):
+            return self.create_source(song_info, stream=stream)
+
+    def add_song(self, song):
+        handle = self.playlist.add_song(song)
+        self.record('add', handle, song.to_entry())
+        return handle
+
+    def remove_song(self, idx):
+        if idx < 0: # Checked before the shift below, which would turn -1 into the handed over entry
+            raise IndexError('playlist index out of range')
+        with self._prepared_lock:
+            if self.handing_over is not None:
+                idx += 1 # The first entry is already playing, it only waits for swapped to leave the playlist
+            handle = self.playlist.handle_at(idx)
+            song = self.playlist.remove(handle)
+            prepared = self.prepared
+            if prepared is not None and prepared[0] is song:
+                self.prepared = None
+            else:
+                prepared = None
+        self.record('remove', handle)
+        if prepared is not None:
+            prepared[2].cleanup()
+            self.prepare_task = self.loop.create_task(self.prepare_next(0))
+        self.prefetcher.cancel(song)
+        self.prefetcher.refill()
+
+    def clear(self):
+        self.discard_prepared()
+        with self._prepared_lock:
+            if self.handing_over is not None: # Playing already, swapped releases it if the guild stopped
+                self.playlist.take(self.handing_over.handle)
+        self.prefetcher.cancel_all()
         self.playlist.clear()
+        self.record('clear')
+
+    async def stop(self):
+        self.clear()
+        self.record('stop')
         if self.voice_client:
             await self.voice_client.disconnect()
             self.voice_client = None
 
     def is_playing(self):
-        return self.voice_client and self.voice_client.is_playing()
+        return self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused() or self.advancing)
+
+    def take_prepared(self, hand_over=False):
+        """Takes the prepared track. The player thread hands it over, so it's never released while it plays."""
+        with self._prepared_lock:
+            prepared, self.prepared = self.prepared, None
+            if hand_over and prepared is not None:
+                self.handing_over = prepared[0]
+        return prepared
+
+    def discard_prepared(self, song=None):
+        """Drops the prepared next track, or only if it is the given song. Returns whether one was dropped."""
+        if song is None and self.prepare_task is not None:
+            self.prepare_task.cancel()
+            self.prepare_task = None
+        with self._prepared_lock:
+            prepared = self.prepared
+            if prepared is None or (song is not None and prepared[0] is not song):
+                return False
+            self.prepared = None
+        prepared[2].cleanup()
+        return True
 
-    async def play_next_song(self, song=None, error=None):
-        if error:
-            await self.current_song.channel.send('An error has occurred while playing {}: {}'.format(self.current_song, error))
+    def schedule_prepare(self, song_info):
+        if self.prepare_task is not None:
+            self.prepare_task.cancel()
+        duration = (song_info.info or {}).get('duration')
+        if self.prewarm and duration:
+            self.prepare_task = self.loop.create_task(self.prepare_next(duration - song_info.start - self.prewarm))
 
-        if song and not song.local_file and song.filename not in [s.filename for s in self.playlist]:
-            os.remove(song.filename)
+    async def prepare_next(self, delay):
+        """Spawns the source of the next track shortly before the current one ends.
 
+        FFmpeg fills its pipe in the meantime, so the player thread can swap it in right after the last frame.
+        """
+        await asyncio.sleep(delay)
+        song_info = next(iter(self.playlist), None)
+        if song_info is None:
+            return
+        stream = self.streaming and song_info.can_stream()
+        if not stream:
+            await song_info.wait_until_downloaded()
+            if song_info.error is not None:
+                return # Reported by play_next_song
+        future = self.loop.run_in_executor(None, self.create_timed_source, song_info, stream)
+        try:
+            source = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda future: future.exception() is None and future.result().cleanup())
+            raise
+        except Exception:
+            logging.exception('Could not prepare %s', song_info)
+            return
+        if next(iter(self.playlist), None) is not song_info or self.voice_client is None:
+            source.cleanup() # Removed or skipped while FFmpeg started
+            return
+        with self._prepared_lock:
+            self.prepared = (song_info, stream, source)
+
+    def player_finished(self, song_info):
+        """Returns the after callback of the player, which runs in the player thread when the track ends."""
+        def after(error):
+            ended_at = time.perf_counter()
+            prepared = self.take_prepared(hand_over=True) if error is None and self.voice_client is not None else None
+            if prepared is not None:
+                next_song_info, _, source = prepared
+                try:
+                    self.voice_client.play(source, after=self.player_finished(next_song_info))
+                except discord.ClientException: # Disconnected in the meantime
+                    source.cleanup()
+                    with self._prepared_lock:
+                        self.handing_over = None
+                else:
+                    TRACK_GAP.observe(time.perf_counter() - ended_at)
+                    self.loop.call_soon_threadsafe(self.swapped, song_info, next_song_info)
+                    return
+            self.advancing = True
+            asyncio.run_coroutine_threadsafe(self.play_next_song(song_info, error, ended_at=ended_at), self.loop).result()
+        return after
+
+    def finished(self, song):
+        song.release()
+        self.loop.create_task(SongInfo.audio_cache.maintain(self.loop))
         self.skips.clear()
 
-        if self.playlist.empty():
-            await self.stop()
-            await self.bot.change_presence(activity=None)
+    def swapped(self, song, next_song_info):
+        """Catches up with a track the player thread already started."""
+        self.finished(song)
+        with self._prepared_lock:
+            self.handing_over = None
+            self.playlist.take(next_song_info.handle) # Already taken if the playlist was cleared
+        if self.voice_client is None: # Stopped in the meantime
+            next_song_info.release()
+            return
+        self.prefetcher.refill()
+        self.started(next_song_info)
+
+    def started(self, song_info):
+        self.started_playing_at = datetime.datetime.now()
+        self.start_offset = song_info.start
+        self.record('play', song_info.handle, self.voice_client.channel.id)
+        if song_info.start:
+            self.record('position', song_info.start)
+        self.schedule_prepare(song_info)
+        play_str = 'Now playing {}'.format(song_info)
+        if self.previous_queuer.id != song_info.requester.id:
+            play_str = play_str.replace('`' + str(song_info.requester) + '`', song_info.requester.mention)
+        self.previous_queuer = song_info.requester
+        # Only the latest track of a guild is worth announcing once the channel's rate limit lets it through
+        self.outbound.send(song_info.channel, play_str, key=('now_playing', self.guild_id))
+        self.outbound.presence_changed()
+
+    async def play_next_song(self, song=None, error=None, requested_at=None, ended_at=None):
+        if song is None and self.is_playing():
+            return # Started by another command in the meantime
+        self.advancing = True
+        try:
+            await self._play_next_song(song, error, requested_at, ended_at)
+        finally:
+            self.advancing = False
+
+    async def _play_next_song(self, song, error, requested_at, ended_at):
+        if error:
+            self.outbound.send(song.channel, 'An error has occurred while playing {}: {}'.format(song, error))
+
+        if song:
+            self.finished(song)
         else:
+            self.skips.clear()
+
+        while True:
+            if self.playlist.empty():
+                self.advancing = False
+                await self.stop()
+                self.outbound.presence_changed()
+                return
             next_song_info = self.playlist.get_song()
-            await next_song_info.wait_until_downloaded()
-            source = Song(next_song_info)
-            source.volume = self.player_volume
-            self.started_playing_at = datetime.datetime.now()
-            self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next_song(next_song_info, e), self.loop).result())
-            play_str = 'Now playing {}'.format(next_song_info)
-            if self.previous_queuer.id != next_song_info.requester.id:
-                play_str = play_str.replace('`' + str(next_song_info.requester) + '`', next_song_info.requester.mention)
-            self.previous_queuer = next_song_info.requester
-            await next_song_info.channel.send(play_str)
-            await self.bot.change_presence(activity=discord.Game(name=next_song_info.info["title"]))
+            self.prefetcher.fetch(next_song_info, executor.NEXT_UP)
+            self.prefetcher.refill()
+            stream = self.streaming and next_song_info.can_stream()
+            if not stream:
+                await next_song_info.wait_until_downloaded()
+                if next_song_info.error is not None:
+                    next_song_info.release()
+                    self.outbound.send(next_song_info.channel, 'Could not play {}: {}'.format(next_song_info, next_song_info.error))
+                    continue
+            break
+
+        prepared = self.take_prepared()
+        if prepared is not None and prepared[0] is next_song_info and prepared[1] == stream:
+            source = prepared[2]
+        else:
+            if prepared is not None:
+                prepared[2].cleanup()
+            # Audio nodes may have to be restarted and FFmpeg spawned, keep that off the loop
+            source = await self.loop.run_in_executor(None, self.create_timed_source, next_song_info, stream)
+            if self.voice_client is None: # Stopped while the source started
+                source.cleanup()
+                next_song_info.release()
+                return
+        self.voice_client.play(source, after=self.player_finished(next_song_info))
+        if ended_at is not None:
+            TRACK_GAP.observe(time.perf_counter() - ended_at)
+        if requested_at is not None:
+            FIRST_AUDIO_TIME.observe(time.perf_counter() - requested_at)
+        self.started(next_song_info)
 
 
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.music_states = {}
-        with open('blacklist.json') as blacklist:
-            blacklist_dict = json.load(blacklist)
-            self.blacklisted_users = set(blacklist_dict["users"])
-            self.blacklisted_videos = set(blacklist_dict["videos"])
-        self.bot.loop.create_task(self.map_channels())
+        SongInfo.audio_cache = AudioCache.from_config(bot.config)
+        SongInfo.metadata_cache = None # Connected by warm_up
+        SongInfo.pool = executor.ExtractorPool.from_config(bot.config)
+        SongInfo.audio_nodes = audionode.AudioNodePool.from_config(bot.config)
+        if SongInfo.audio_nodes is not None:
+            SongInfo.audio_nodes.start()
+        if bot.config.get('audio_mode', 'pcm') == 'opus':
+            SongInfo.opus_bitrate = bot.config.get('opus_bitrate', 96)
+        loudness_config = bot.config.get('loudness', {})
+        if loudness_config.get('enabled', False):
+            SongInfo.loudness_target = loudness_config.get('target', -16.0)
+        self.blacklist_store = BlacklistStore.from_config(bot.config)
+        self.blacklisted_users = set() # Loaded by warm_up, commands wait for it
+        self.blacklisted_videos = BlacklistMatcher()
+        self.queue_store = QueueStore.from_config(bot.config)
+        self.saved_queues = {}
+        self.warmed_up = asyncio.Event() # Only set once everything loaded, the blacklist must never fail open
+        self.warm_up_task = self.bot.loop.create_task(self.warm_up())
+        self.bot.loop.create_task(self.resume_queues())
+        self.position_task = self.bot.loop.create_task(self.record_positions())
+        self.blacklist_task = self.bot.loop.create_task(self.refresh_blacklist())
+        self.outbound = OutboundScheduler.from_config(bot, bot.config, presence=self.current_activity)
+        self.listeners = VoiceListeners()
+        self.register_metrics()
+
+    def register_metrics(self):
+        metrics.Gauge('musicbot_queue_depth', 'Songs queued per guild.', ['guild'],
+                      callback=lambda: {(guild_id,): state.playlist.qsize() for guild_id, state in self.music_states.items()})
+        metrics.Gauge('musicbot_playing_guilds', 'Guilds currently playing audio.',
+                      callback=lambda: sum(1 for state in self.music_states.values() if state.voice_client and state.voice_client.is_playing()))
+        metrics.Gauge('musicbot_prefetch_in_flight', 'Downloads running or queued by the prefetchers.',
+                      callback=lambda: sum(len(state.prefetcher.tasks) for state in self.music_states.values()))
+        metrics.Gauge('musicbot_extractor_pool_jobs', 'Extractor pool jobs.', ['state'],
+                      callback=lambda: {('running',): SongInfo.pool.active, ('queued',): SongInfo.pool.queued})
+        metrics.Gauge('musicbot_audio_cache_bytes', 'Size of the audio cache.', callback=lambda: SongInfo.audio_cache.total_bytes)
+        metrics.CallbackCounter('musicbot_audio_cache_lookups', 'Audio cache lookups.', ['result'],
+                                callback=lambda: {('hit',): SongInfo.audio_cache.hits, ('miss',): SongInfo.audio_cache.misses})
+        metrics.CallbackCounter('musicbot_metadata_cache_lookups', 'Metadata cache lookups.', ['result'],
+                                callback=lambda: {('hit',): SongInfo.metadata_cache.hits, ('miss',): SongInfo.metadata_cache.misses}
+                                                 if SongInfo.metadata_cache is not None else {})
+        metrics.Gauge('musicbot_outbound_queued', 'Announcements and reactions waiting for their rate limit bucket.',
+                      callback=lambda: self.outbound.queued)
+        metrics.CallbackCounter('musicbot_outbound_actions', 'Outbound announcements, reactions and presence updates.', ['result'],
+                                callback=lambda: {('sent',): self.outbound.sent, ('superseded',): self.outbound.dropped['superseded'],
+                                                  ('overflow',): self.outbound.dropped['overflow']})
 
     def cog_unload(self):
+        self.position_task.cancel()
+        self.blacklist_task.cancel()
+        for name in ('musicbot_queue_depth', 'musicbot_playing_guilds', 'musicbot_prefetch_in_flight', 'musicbot_extractor_pool_jobs',
+                     'musicbot_audio_cache_bytes', 'musicbot_audio_cache_lookups', 'musicbot_metadata_cache_lookups',
+                     'musicbot_outbound_queued', 'musicbot_outbound_actions'):
+            metrics.REGISTRY.unregister(name)
         for state in self.music_states.values():
+            state.queue_store = None # Keep the persisted queue so it is resumed on the next load
             self.bot.loop.create_task(state.stop())
+        self.bot.loop.create_task(self.queue_store.close())
+        self.blacklist_store.close()
+        self.outbound.close()
+        if SongInfo.audio_nodes is not None:
+            SongInfo.audio_nodes.close()
+
+    async def flush(self):
+        """Writes out the buffered queue events, called by the bot before it closes."""
+        await self.queue_store.close()
 
     def cog_check(self, ctx):
         if not ctx.guild:
@@ -287,6 +1321,9 @@ class Music(commands.Cog):
 
     async def cog_before_invoke(self, ctx):
         ctx.music_state = self.get_music_state(ctx.guild.id)
+        await asyncio.shield(self.warm_up_task) # Only takes time for commands sent right after startup
+        if not self.warmed_up.is_set():
+            raise MusicError('Music commands are unavailable, the bot could not load its data. Check the logs.')
 
     async def cog_command_error(self, ctx, error):
         if not isinstance(error, commands.UserInputError):
@@ -298,37 +1335,155 @@ class Music(commands.Cog):
             pass # /shrug
 
     def get_music_state(self, guild_id):
-        return self.music_states.setdefault(guild_id, GuildMusicState(self.bot))
+        state = self.music_states.get(guild_id)
+        if state is None:
+            state = self.music_states[guild_id] = GuildMusicState(self.bot, guild_id, self.queue_store)
+            state.prefetcher.check = self.check_imported_song
+            state.outbound = self.outbound
+        return state
+
+    @commands.Cog.listener()
+    async def on_config_reload(self, old, new):
+        for state in self.music_states.values():
+            state.apply_config(new)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id:
+            if before.channel is not None and after.channel != before.channel:
+                self.listeners.forget(before.channel.id)
+            return
+        self.listeners.update(member, before, after)
+        state = self.music_states.get(member.guild.id)
+        if state is not None and member.id in state.skips and state.voice_client is not None:
+            if member.id not in self.listeners.members(state.voice_client.channel):
+                state.skips.discard(member.id)
+
+    def current_activity(self):
+        """The presence shows the track of the only playing guild, or how many guilds are playing."""
+        playing = [state for state in self.music_states.values()
+                   if state.voice_client and (state.voice_client.is_playing() or state.voice_client.is_paused())]
+        if not playing:
+            return None
+        if len(playing) == 1:
+            return discord.Game(name=playing[0].current_song.info['title'])
+        return discord.Game(name='music in {} servers'.format(len(playing)))
+
+    async def warm_up(self):
+        """Reads the caches, blacklist and queues on disk while the bot connects. Commands wait for it and are rejected if it failed."""
+        loop = self.bot.loop
+        started = time.perf_counter()
+        library = LibraryIndex.from_config(self.bot.config)
+        jobs = (
+            SongInfo.get_ytdl, # youtube_dl takes a while to import, do it here instead of on the loop at the first play
+            functools.partial(MetadataCache.from_config, self.bot.config),
+            self.blacklist_store.load,
+            SongInfo.audio_cache.load,
+            library.load if library.directories else lambda: None,
+            functools.partial(self.queue_store.load_all, self.owns_guild),
+        )
+        try:
+            _, SongInfo.metadata_cache, (blacklisted_users, blacklisted_videos), _, _, self.saved_queues = await asyncio.gather(
+                *(loop.run_in_executor(None, job) for job in jobs))
+        except Exception:
+            # Running without the blacklist would let blacklisted users and videos through, keep the commands rejected
+            self.bot.logger.exception('Could not warm up, music commands are disabled until the cog is reloaded')
+            return
+        self.blacklisted_users = blacklisted_users
+        self.blacklisted_videos = BlacklistMatcher(blacklisted_videos)
+        if library.directories:
+            SongInfo.library = library
+            loop.create_task(library.scan(SongInfo.pool))
+        self.warmed_up.set()
+        self.bot.logger.info('Warmed up in %.2fs', time.perf_counter() - started)
+        await loop.run_in_executor(None, SongInfo.metadata_cache.purge)
+
+    async def resume_queues(self):
+        await self.bot.wait_until_ready()
+        await self.warmed_up.wait()
+        saved_queues, self.saved_queues = self.saved_queues, {}
+        for guild_id, saved in saved_queues.items():
+            if self.bot.get_guild(guild_id) is None:
+                continue
+            try:
+                await self.get_music_state(guild_id).restore(saved)
+            except Exception:
+                self.bot.logger.exception('Could not resume the queue of guild %s', guild_id)
+
+    def owns_guild(self, guild_id):
+        """Whether this process handles the guild, cluster workers only run some of the shards."""
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_ids:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    async def refresh_blacklist(self):
+        """Picks up blacklist changes made by other cluster workers."""
+        interval = self.bot.config.get('blacklist', {}).get('refresh_interval', 10)
+        await self.warmed_up.wait()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                refreshed = await self.blacklist_store.poll()
+            except (OSError, ValueError): # ValueError for a corrupt snapshot, keep the last good sets and retry
+                self.bot.logger.exception('Could not refresh the blacklist')
+                continue
+            if refreshed is not None:
+                self.blacklisted_users, blacklisted_videos = refreshed
+                self.blacklisted_videos = BlacklistMatcher(blacklisted_videos)
+            if self.blacklist_store.needs_compaction: # Changes appended by other workers count too
+                try:
+                    await self.blacklist_store.compact()
+                except (OSError, ValueError):
+                    self.bot.logger.exception('Could not compact the blacklist')
+
+    async def record_positions(self):
+        interval = self.bot.config.get('queue_state', {}).get('position_interval', 15)
+        while True:
+            await asyncio.sleep(interval)
+            for state in self.music_states.values():
+                if state.voice_client and state.voice_client.is_playing():
+                    state.record('position', round(state.position, 2))
+
+    async def connect_to_author(self, ctx):
+        valid_channels = self.bot.config.voice_channels.get(ctx.guild.id, frozenset())
+        if not ctx.author.voice or not ctx.author.voice.channel or ctx.author.voice.channel.id not in valid_channels:
+            channels = (ctx.guild.get_channel(channel_id) for channel_id in valid_channels)
+            clean_channel_list = ['`' + x.name + '`' for x in channels if x is not None]
+            raise MusicError('You are not in a valid voice channel. Valid voice channels are {}'.format(", ".join(clean_channel_list)))
 
+        # Connect to the voice channel if needed
+        if ctx.voice_client is None or not ctx.voice_client.is_connected():
+            try:
+                ctx.music_state.voice_client = await ctx.author.voice.channel.connect()
+            except KeyError:
+                await ctx.invoke(self.join)
 
-    async def map_channels(self):
-        await self.bot.wait_until_ready()
-        config_dict = {}
-        for guild_id in self.bot.config["voice_channel"]:
-            config_dict[guild_id] = []
-            for channel_id in self.bot.config["voice_channel"][guild_id]:
-                config_dict[guild_id].append(self.bot.get_channel(channel_id))
-        self.valid_channels = config_dict
-        print(self.valid_channels)
+    async def check_imported_song(self, song):
+        _, blacklist_status, video_too_long = await self.can_content_be_played(song)
+        if video_too_long:
+            raise MusicError('Video is too long (`{}` > `{}`)'.format(song.info["duration"], self.bot.config.song_length))
+        if blacklist_status:
+            raise MusicError('Video content has been blacklisted.')
 
     async def can_content_be_played(self, song: SongInfo):
         too_long = False
         blacklist_status = False
-        if song.info["duration"] > self.bot.config["song_length"]:
+        if song.info.get("duration", 0) > self.bot.config.song_length:
             too_long = True
             return None, blacklist_status, too_long
-        for blacklisted_item in self.blacklisted_videos:
-            if blacklisted_item in song.info["title"] or blacklisted_item in song.info["description"] or blacklisted_item in song.info["id"] or blacklisted_item in song.info["uploader"]:
-                blacklist_status = True
-                return blacklisted_item, blacklist_status, too_long
-        return None, blacklist_status, too_long
+        blacklisted_item = self.blacklisted_videos.match(song.info)
+        if blacklisted_item is not None:
+            blacklist_status = True
+        return blacklisted_item, blacklist_status, too_long
 
     @commands.command(aliases=['np'])
     async def status(self, ctx):
         """Displays the currently played song."""
-        if ctx.music_state.is_playing():
-            song = ctx.music_state.current_song
-            seconds_in = duration_to_str((datetime.datetime.now() - ctx.music_state.started_playing_at).seconds)
+        song = ctx.music_state.current_song
+        started_playing_at = ctx.music_state.started_playing_at
+        if ctx.music_state.is_playing() and song is not None and started_playing_at is not None:
+            seconds_in = duration_to_str((datetime.datetime.now() - started_playing_at).seconds)
             await ctx.send('Playing {}. Volume at {} in {} ({} in)'.format(song, str(song.volume * 100), ctx.voice_client.channel.mention, seconds_in))
         else:
             await ctx.send('Not playing.')
@@ -361,16 +1516,14 @@ class Music(commands.Cog):
     async def play(self, ctx, *, request: str):
         """Plays a song or adds it to the playlist.
 
-        Automatically searches with youtube_dl
+        Automatically searches with youtube_dl, prefix the request with local: to search the local music library instead
         List of supported sites :
         https://github.com/rg3/youtube-dl/blob/1b6712ab2378b2e8eb59f372fb51193f8d3bdc97/docs/supportedsites.md
         """
+        requested_at = time.perf_counter()
         if ctx.author.id in self.blacklisted_users:
             raise MusicError('Cannot add track, {} has been blacklisted.'.format(ctx.author))
-        try:
-            await ctx.message.add_reaction('\N{HOURGLASS}')
-        except:
-            pass
+        self.outbound.add_reaction(ctx.message, '\N{HOURGLASS}')
 
         # Create the SongInfo
         song = await SongInfo.create(request, ctx.author, ctx.channel, loop=ctx.bot.loop)
@@ -378,49 +1531,72 @@ class Music(commands.Cog):
         # Check if song can be played
         _, blacklist_status, video_too_long = await self.can_content_be_played(song)
         if video_too_long and not await not_check_has_super_powers(ctx):
-            raise MusicError('Video is too long (`{}` > `{}`)'.format(song.info["duration"], self.bot.config["song_length"]))
+            raise MusicError('Video is too long (`{}` > `{}`)'.format(song.info["duration"], self.bot.config.song_length))
         if blacklist_status:
             raise MusicError('Video content has been blacklisted. If you believe this to be in error, contact staff.')
 
-        if not ctx.author.voice or not ctx.author.voice.channel or ctx.author.voice.channel.id not in [x.id for x in self.valid_channels[ctx.guild.id]]:
-            clean_channel_list = ['`' + x.name + '`' for x in self.valid_channels[ctx.guild.id]]
-            raise MusicError('You are not in a valid voice channel. Valid voice channels are {}'.format(", ".join(clean_channel_list)))
-
-        # Connect to the voice channel if needed
-        if ctx.voice_client is None or not ctx.voice_client.is_connected():
-            try:
-                ctx.music_state.voice_client = await ctx.author.voice.channel.connect()
-            except KeyError:
-                await ctx.invoke(self.join)
+        await self.connect_to_author(ctx)
 
         # Add the info to the playlist
         try:
-            ctx.music_state.playlist.add_song(song)
+            ctx.music_state.add_song(song)
         except asyncio.QueueFull:
             raise MusicError('Playlist is full, try again later.')
 
         if not ctx.music_state.is_playing():
-            # Download the song and play it
-            await song.download(ctx.bot.loop)
-            await ctx.music_state.play_next_song()
+            # Download the song and play it, or stream it while it downloads in the background
+            if not (ctx.music_state.streaming and song.can_stream()):
+                await song.download(ctx.bot.loop, priority=executor.NEXT_UP)
+            await ctx.music_state.play_next_song(requested_at=requested_at)
         else:
-            # Schedule the song's download
-            ctx.bot.loop.create_task(song.download(ctx.bot.loop))
+            # Schedule the song's download if it falls within the prefetch window
+            ctx.music_state.prefetcher.refill()
             await ctx.send('Queued {} in position **#{}**'.format(song, ctx.music_state.playlist.qsize()))
 
-        try:
-            await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
-            await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
-        except:
-            pass
+        self.outbound.remove_reaction(ctx.message, '\N{HOURGLASS}', ctx.me)
+        self.outbound.add_reaction(ctx.message, '\N{WHITE HEAVY CHECK MARK}')
+
+    @commands.command(name='import')
+    async def import_playlist(self, ctx, *, url: str):
+        """Adds all entries of a playlist to the queue.
+
+        Entries are only resolved shortly before they get played, so even huge playlists are queued instantly.
+        """
+        if ctx.author.id in self.blacklisted_users:
+            raise MusicError('Cannot add tracks, {} has been blacklisted.'.format(ctx.author))
+        if ctx.music_state.playlist.full():
+            raise MusicError('Playlist is full, try again later.')
+        self.outbound.add_reaction(ctx.message, '\N{HOURGLASS}')
+
+        entries = await SongInfo.pool.run(executor.INTERACTIVE, extract_flat, url, ctx.music_state.playlist.free_slots(),
+                                          guild_id=ctx.guild.id)
+        if not entries:
+            raise MusicError('Could not retrieve a playlist from input : {}'.format(url))
+
+        await self.connect_to_author(ctx)
+
+        added = 0
+        for entry in entries:
+            try:
+                ctx.music_state.add_song(SongInfo.placeholder(entry, ctx.author, ctx.channel))
+            except asyncio.QueueFull:
+                break
+            added += 1
+
+        if not ctx.music_state.is_playing():
+            await ctx.music_state.play_next_song()
+        else:
+            ctx.music_state.prefetcher.refill()
+        await ctx.send('Queued {} songs from the playlist.'.format(added))
+
+        self.outbound.remove_reaction(ctx.message, '\N{HOURGLASS}', ctx.me)
+        self.outbound.add_reaction(ctx.message, '\N{WHITE HEAVY CHECK MARK}')
 
     @play.error
+    @import_playlist.error
     async def play_error(self, ctx, error):
-        try:
-            await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
-            await ctx.message.add_reaction('\N{CROSS MARK}')
-        except:
-            pass
+        self.outbound.remove_reaction(ctx.message, '\N{HOURGLASS}', ctx.me)
+        self.outbound.add_reaction(ctx.message, '\N{CROSS MARK}')
         self.bot.logger.exception("Something went wrong:")
 
     @commands.command(name='remove') # Weird?
@@ -432,7 +1608,7 @@ class Music(commands.Cog):
         if idx < 0:
             raise MusicError('Position must be above 0!')
         try:
-            ctx.music_state.playlist.delete_song(idx - 1)
+            ctx.music_state.remove_song(idx - 1)
         except IndexError:
             raise MusicError('Invalid song position.')
         else:
@@ -461,9 +1637,9 @@ class Music(commands.Cog):
 
         Staff & Helpers only."""
         if user.id not in self.blacklisted_users:
+            # Persisted first, a change that could not be written never takes effect
+            await self.blacklist_store.record('add', 'users', user.id)
             self.blacklisted_users.add(user.id)
-            with open('blacklist.json', 'w') as blacklist_file:
-                json.dump({"users": list(self.blacklisted_users), "videos": list(self.blacklisted_videos)}, blacklist_file)
             return await ctx.send('Successfully blacklisted user `{}`!'.format(str(user)))
         else:
             return await ctx.send('User already blacklisted.')
@@ -474,13 +1650,11 @@ class Music(commands.Cog):
         """Removes a user from the blacklist.
 
         Staff & Helpers only."""
-        try:
-            self.blacklisted_users.remove(user.id)
-        except KeyError:
+        if user.id not in self.blacklisted_users:
             return await ctx.send('User not blacklisted.')
         else:
-            with open('blacklist.json', 'w') as blacklist_file:
-                json.dump({"users": list(self.blacklisted_users), "videos": list(self.blacklisted_videos)}, blacklist_file)
+            await self.blacklist_store.record('remove', 'users', user.id)
+            self.blacklisted_users.discard(user.id)
             return await ctx.send('Successfully removed user {} from blacklist!'.format(str(user)))
 
     @user.command(name='show')
@@ -523,9 +1697,8 @@ class Music(commands.Cog):
                 string = url.query['v']
 
         if string not in self.blacklisted_videos:
+            await self.blacklist_store.record('add', 'videos', string)
             self.blacklisted_videos.add(string)
-            with open('blacklist.json', 'w') as blacklist_file:
-                json.dump({"users": list(self.blacklisted_users), "videos": list(self.blacklisted_videos)}, blacklist_file)
             return await ctx.send('Successfully blacklisted video content `{}`!'.format(string))
         else:
             return await ctx.send('Video content already on blacklist.')
@@ -545,13 +1718,12 @@ class Music(commands.Cog):
                 string = url.path[1:]
             else:
                 string = url.query['v']
-        try:
-            self.blacklisted_videos.remove(string)
-        except KeyError:
+        if string not in self.blacklisted_videos:
             return await ctx.send('Video content not blacklisted.')
         else:
-            with open('blacklist.json', 'w') as blacklist_file:
-                json.dump({"users": list(self.blacklisted_users), "videos": list(self.blacklisted_videos)}, blacklist_file)
+            await self.blacklist_store.record('remove', 'videos', string)
+            if string in self.blacklisted_videos: # Also removed by a concurrent command otherwise
+                self.blacklisted_videos.remove(string)
             return await ctx.send('Successfully removed video content `{}` from blacklist!'.format(string))
 
     @video.command(name='show')
@@ -601,7 +1773,7 @@ class Music(commands.Cog):
         Staff & Helpers only."""
         if volume < 0 or volume > 100:
             raise MusicError('The volume level has to be between 0 and 100.')
-        ctx.music_state.volume = volume / 100
+        await ctx.music_state.set_volume(volume / 100)
 
     @commands.command()
     @has_super_powers()
@@ -609,7 +1781,7 @@ class Music(commands.Cog):
         """Clears the playlist.
         
         Staff & Helpers only."""
-        ctx.music_state.playlist.clear()
+        ctx.music_state.clear()
 
     @commands.command()
     async def skip(self, ctx):
@@ -628,34 +1800,28 @@ class Music(commands.Cog):
         if ctx.author.id in ctx.music_state.skips:
             raise MusicError('{} You already voted to skip that song'.format(ctx.author.mention))
 
-        if ctx.author not in ctx.music_state.voice_client.channel.members:
+        if ctx.author.voice is None or ctx.author.voice.channel != ctx.music_state.voice_client.channel:
             raise MusicError('You are not in the voice channel.')
 
         if ctx.author.voice.deaf or ctx.author.voice.self_deaf:
             raise MusicError('{} Not counting skip (you are deaf).'.format(ctx.author.mention))
 
-        # Count the vote
+        # Count the vote, it expires when the voter stops listening
         ctx.music_state.skips.add(ctx.author.id)
-        try:
-            await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
-        except:
-            pass
+        self.outbound.add_reaction(ctx.message, '\N{WHITE HEAVY CHECK MARK}')
 
-
-        # Get total amount of members in voice channel, exempting the bot and deafened users.
-        for listener in ctx.music_state.voice_client.channel.members:
-            logging.info("Listener: %s, Self deaf: %s, Guild deaf: %s", listener, listener.voice.self_deaf, listener.voice.deaf)
-        listeners_list = [x for x in ctx.music_state.voice_client.channel.members if not x.voice.deaf and not x.voice.self_deaf]
-        listeners = len(listeners_list) - 1
+        listeners = self.listeners.count(ctx.music_state.voice_client.channel)
         logging.info("%d listeners", listeners)
 
         # Calculate if percentage to skip matches
-        percentage_count = listeners * self.bot.config["percentage_skip"]
+        percentage_count = listeners * self.bot.config.percentage_skip
         logging.info('%d minimum percentage skips', percentage_count)
         percentage_skip = len(ctx.music_state.skips) >= percentage_count
 
         # Check if the song has to be skipped
-        if len(ctx.music_state.skips) > ctx.music_state.min_skips or percentage_skip or ctx.author == ctx.music_state.current_song.requester:
+        current_song = ctx.music_state.current_song # None while the next track starts
+        requested = current_song is not None and ctx.author == current_song.requester
+        if len(ctx.music_state.skips) > ctx.music_state.min_skips or percentage_skip or requested:
             ctx.music_state.skips.clear()
             ctx.voice_client.stop()
             await ctx.send("Skipped song!")
@@ -684,3 +1850,28 @@ class Music(commands.Cog):
 
         Staff & Helpers only."""
         ctx.music_state.min_skips = number
+
+    @commands.command()
+    @has_super_powers()
+    async def prefetch(self, ctx):
+        """Shows the state of the download window.
+
+        Staff & Helpers only."""
+        status = ctx.music_state.prefetcher.status()
+        await ctx.send('Prefetch window: {window} songs, {ready} ready, {in_flight} downloading, {resolving} resolving ahead, {queued} queued in total.'.format(**status))
+
+    @commands.command()
+    @has_super_powers()
+    async def rescan(self, ctx):
+        """Updates the local music library index.
+
+        Only new and changed files are read again.
+
+        Staff & Helpers only."""
+        if SongInfo.library is None:
+            raise MusicError('No local music library is configured.')
+        if SongInfo.library.scanning:
+            raise MusicError('The library is already being scanned.')
+        await ctx.send('Scanning the local music library...')
+        await SongInfo.library.scan(SongInfo.pool)
+        await ctx.send('Library scan done, {} files indexed.'.format(len(SongInfo.library)))
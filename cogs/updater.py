@@ -1,6 +1,5 @@
 import discord
 from discord.ext import commands
-from git import Repo
 import os
 import subprocess
 import sys
@@ -13,7 +12,14 @@ def setup(bot):
 class Git(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.repo = Repo(os.getcwd())
+        self._repo = None
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            from git import Repo # GitPython is slow to import, only load it once an update is requested
+            self._repo = Repo(os.getcwd())
+        return self._repo
 
     async def hastebin(self, content):
         """Upload output to hastebin
@@ -13,23 +13,25 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+STARTED_AT = time.perf_counter()
+
 import logging
 import yaml
 import discord
 from discord.ext import commands
+import datetime
+import io
 import os
+from utils.config import ConfigSnapshot, ConfigWatcher
+from utils.profiling import LoopWatchdog, SamplingProfiler
+IMPORTED_AT = time.perf_counter()
 
 '''Bot framework that can dynamically load and unload cogs.'''
 
-config = yaml.safe_load(open('config.yml'))
+config = ConfigSnapshot.load('config.yml')
 secure = yaml.safe_load(open('secure.yml'))
-bot = commands.Bot(command_prefix=commands.when_mentioned_or(
-    config['prefix']),
-    description='')
-bot.config = config
-
-bot.loaded_cogs = []
-bot.unloaded_cogs = []
+CONFIGURED_AT = time.perf_counter()
 
 def initLogging():
     logformat = "%(asctime)s %(name)s:%(levelname)s:%(message)s"
@@ -42,23 +44,25 @@ def check_if_dirs_exist():
     '''Function that creates the "cogs" directory if it doesn't exist already'''
     os.makedirs('cogs', exist_ok=True)
 
-def load_autoload_cogs():
+def load_autoload_cogs(bot):
     '''
-    Loads all .py files in the cogs subdirectory that are in the config file as "autoload_cogs" as cogs into the bot. 
-    If your cogs need to reside in subfolders (ie. for config files) create a wrapper file in the cogs 
+    Loads all .py files in the cogs subdirectory that are in the config file as "autoload_cogs" as cogs into the bot.
+    If your cogs need to reside in subfolders (ie. for config files) create a wrapper file in the cogs
     directory to load the cog.
     '''
     for entry in os.listdir('cogs'):
-        if entry.endswith('.py') and os.path.isfile('cogs/{}'.format(entry)) and entry[:-3] in config['autoload_cogs']:
+        if entry.endswith('.py') and os.path.isfile('cogs/{}'.format(entry)) and entry[:-3] in bot.config['autoload_cogs']:
+            started = time.perf_counter()
             try:
                 bot.load_extension("cogs.{}".format(entry[:-3]))
                 bot.loaded_cogs.append(entry[:-3])
+                bot.startup_phases.append(('cog {}'.format(entry[:-3]), time.perf_counter() - started))
             except Exception as e:
                 print(e)
             else:
                 print('Successfully loaded cog {}'.format(entry))
 
-def get_names_of_unloaded_cogs():
+def get_names_of_unloaded_cogs(bot):
     '''
     Creates an easy loadable list of cogs.
     If your cogs need to reside in subfolders (ie. for config files) create a wrapper file in the auto_cogs
@@ -68,29 +72,50 @@ def get_names_of_unloaded_cogs():
         if entry.endswith('.py') and os.path.isfile('cogs/{}'.format(entry)) and entry[:-3] not in bot.loaded_cogs:
             bot.unloaded_cogs.append(entry[:-3])
 
-check_if_dirs_exist()
-load_autoload_cogs()
-get_names_of_unloaded_cogs()
-
-@bot.command()
+@commands.command()
 @commands.is_owner()
 async def list_cogs(ctx):
     '''Lists all cogs and their status of loading.'''
     cog_list = commands.Paginator(prefix='', suffix='')
     cog_list.add_line('**✅ Successfully loaded:**')
-    for cog in bot.loaded_cogs:
+    for cog in ctx.bot.loaded_cogs:
         cog_list.add_line('- ' + cog)
     cog_list.add_line('**❌ Not loaded:**')
-    for cog in bot.unloaded_cogs:
+    for cog in ctx.bot.unloaded_cogs:
         cog_list.add_line('- ' + cog)
-    
+
     for page in cog_list.pages:
         await ctx.send(page)
 
-@bot.command()
+@commands.command()
+@commands.is_owner()
+async def profile(ctx, seconds: float = 10.0):
+    '''Samples all threads for the given number of seconds and uploads the collapsed stacks.
+
+    The file can be turned into a flamegraph with flamegraph.pl or opened in speedscope.'''
+    profiler_config = ctx.bot.config.get('profiler', {})
+    seconds = max(1.0, min(seconds, profiler_config.get('max_seconds', 120)))
+    await ctx.send('Profiling for {} seconds...'.format(seconds))
+    profiler = SamplingProfiler(interval=profiler_config.get('interval', 0.005))
+    await ctx.bot.loop.run_in_executor(None, profiler.run, seconds)
+    filename = 'profile-{}.collapsed'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    await ctx.send('Collected {} samples.'.format(profiler.samples),
+                   file=discord.File(io.BytesIO(profiler.collapsed().encode('utf-8')), filename=filename))
+
+@commands.command()
+@commands.is_owner()
+async def reload_config(ctx):
+    '''Reloads config.yml now instead of waiting for the watcher to notice the change.'''
+    error = await ctx.bot.config_watcher.reload()
+    if error is not None:
+        return await ctx.send('💢 Config not reloaded, the old one stays active: {}'.format(error))
+    await ctx.send('✅ Config reloaded.')
+
+@commands.command()
 @commands.is_owner()
 async def load(ctx, cog):
     '''Try and load the selected cog.'''
+    bot = ctx.bot
     if cog not in bot.unloaded_cogs:
         await ctx.send('⚠ WARNING: Cog appears not to be found in the available cogs list. Will try loading anyway.')
     if cog in bot.loaded_cogs:
@@ -105,9 +130,10 @@ async def load(ctx, cog):
         bot.unloaded_cogs.remove(cog)
         await ctx.send('✅ Cog successfully loaded.')
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
 async def unload(ctx, cog):
+    bot = ctx.bot
     if cog not in bot.loaded_cogs:
         return await ctx.send('💢 Cog not loaded.')
     bot.unload_extension('cogs.{}'.format((cog)))
@@ -115,7 +141,7 @@ async def unload(ctx, cog):
     bot.unloaded_cogs.append(cog)
     await ctx.send('✅ Cog successfully unloaded.')
 
-@bot.command()
+@commands.command()
 async def about(ctx):
     """About Soundhax 2"""
     embed = discord.Embed(title="Soundhax 2")
@@ -125,13 +151,96 @@ async def about(ctx):
     embed.description = "A music bot."
     await ctx.send(embed=embed)
 
-@bot.event
-async def on_ready():
-    print('----------')
-    print('Logged in as:')
-    print(bot.user.name)
-    print(bot.user.id)
-    print('----------')
+class FlushOnClose:
+    '''Lets the cogs write out buffered state before they are unloaded and the event loop stops.
+
+    Runs on logout as well as on Ctrl+C or SIGTERM, cogs opt in with a ``flush`` coroutine.
+    '''
+    async def close(self):
+        for cog in list(self.cogs.values()):
+            flush = getattr(cog, 'flush', None)
+            if flush is None:
+                continue
+            try:
+                await flush()
+            except Exception:
+                self.logger.exception('Could not flush cog %s', type(cog).__name__)
+        await super().close()
+
+class Bot(FlushOnClose, commands.Bot):
+    pass
+
+class AutoShardedBot(FlushOnClose, commands.AutoShardedBot):
+    pass
+
+def get_prefix(bot, message):
+    # Looked up on every message so prefix changes apply on reload
+    return commands.when_mentioned_or(bot.config['prefix'])(bot, message)
+
+def create_bot(shard_ids=None, shard_count=None, worker_id=None):
+    '''
+    Builds the bot with its cogs and commands.
+    Cluster workers pass the shards they run out of shard_count, see cluster.py.
+    '''
+    options = dict(command_prefix=get_prefix, description='')
+    if shard_ids is None:
+        bot = Bot(**options)
+    else:
+        bot = AutoShardedBot(shard_ids=shard_ids, shard_count=shard_count, **options)
+    bot.config = config
+    bot.config_watcher = ConfigWatcher.from_config(bot)
+    bot.worker_id = worker_id
+    bot.logger = initLogging()
+
+    bot.loaded_cogs = []
+    bot.unloaded_cogs = []
+    bot.startup_phases = [('imports', IMPORTED_AT - STARTED_AT), ('config', CONFIGURED_AT - IMPORTED_AT)]
+    bot.ready_after = None
+
+    check_if_dirs_exist()
+    load_autoload_cogs(bot)
+    get_names_of_unloaded_cogs(bot)
+
+    for command in (list_cogs, profile, reload_config, load, unload, about):
+        bot.add_command(command)
+
+    @bot.event
+    async def on_ready():
+        if bot.ready_after is None: # Reconnects fire on_ready again
+            now = time.perf_counter()
+            bot.ready_after = now - STARTED_AT
+            phases = bot.startup_phases + [('connect', now - getattr(bot, 'connect_started', now))]
+            print('Ready after {:.2f}s ({})'.format(bot.ready_after, ', '.join('{} {:.2f}s'.format(*phase) for phase in phases)))
+        print('----------')
+        print('Logged in as:')
+        print(bot.user.name)
+        print(bot.user.id)
+        if shard_ids is not None:
+            print('Worker {}, shards {} of {}'.format(worker_id, shard_ids, shard_count))
+        print('----------')
+
+    return bot
+
+def start_watchdog(bot):
+    '''Starts reporting event loop stalls longer than the configured threshold, with the stack causing them.'''
+    watchdog_config = bot.config.get('watchdog', {})
+    if not watchdog_config.get('enabled', True):
+        return
+    bot.watchdog = LoopWatchdog(bot.loop, threshold=watchdog_config.get('threshold', 0.25))
+    bot.watchdog.start()
+
+def start_config_watcher(bot):
+    '''Reloads config.yml whenever it changes.'''
+    if bot.config_watcher.interval:
+        bot.loop.create_task(bot.config_watcher.run())
+
+def run(shard_ids=None, shard_count=None, worker_id=None):
+    bot = create_bot(shard_ids, shard_count, worker_id)
+    start_watchdog(bot)
+    start_config_watcher(bot)
+    # Caches are warmed up in the background, connecting only waits for the gateway
+    bot.connect_started = time.perf_counter()
+    bot.run(secure["token"])
 
-bot.logger = initLogging()
-bot.run(secure["token"])
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.blackliststore import BlacklistStore
+
+
+class BlacklistStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop) # The store's lock binds to it on older Pythons
+        self.addCleanup(asyncio.set_event_loop, None)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot_path = os.path.join(directory.name, 'blacklist.json')
+        self.journal_path = os.path.join(directory.name, 'blacklist.journal')
+
+    def store(self, compact_after=100):
+        store = BlacklistStore(self.snapshot_path, self.journal_path, compact_after=compact_after)
+        self.addCleanup(store.close)
+        store.load()
+        return store
+
+    def record(self, store, *change):
+        self.loop.run_until_complete(store.record(*change))
+
+    def test_existing_snapshot_is_picked_up(self):
+        with open(self.snapshot_path, 'w') as snapshot:
+            json.dump({'users': [1, 2], 'videos': ['abc']}, snapshot)
+        self.assertEqual(self.store().load(), ({1, 2}, {'abc'}))
+
+    def test_recorded_changes_survive_a_restart(self):
+        store = self.store()
+        self.record(store, 'add', 'users', 1)
+        self.record(store, 'add', 'videos', 'abc')
+        self.record(store, 'remove', 'users', 1)
+        self.assertEqual(self.store().load(), (set(), {'abc'}))
+
+    def test_torn_entry_is_dropped_and_cut_off(self):
+        with open(self.journal_path, 'w') as journal:
+            journal.write('["add", "users", 1]\n["add", "vid')
+        with self.assertLogs('utils.jsonfiles', 'WARNING'):
+            store = self.store()
+        self.assertEqual(store.state['users'], {1})
+        self.record(store, 'add', 'videos', 'abc')
+        with open(self.journal_path) as journal:
+            self.assertEqual(journal.read(), '["add", "users", 1]\n["add", "videos", "abc"]\n')
+
+    def test_compaction_folds_the_journal_into_the_snapshot(self):
+        store = self.store(compact_after=2)
+        self.record(store, 'add', 'users', 1)
+        self.assertFalse(store.needs_compaction)
+        self.record(store, 'add', 'users', 2)
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        with open(self.snapshot_path) as snapshot:
+            self.assertEqual(json.load(snapshot), {'users': [1, 2], 'videos': []})
+        self.assertEqual(self.store().load(), ({1, 2}, set()))
+
+    def test_failed_write_leaves_the_state_untouched(self):
+        store = self.store()
+        with mock.patch.object(store, '_append', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.record(store, 'add', 'users', 1)
+        self.assertEqual(store.state['users'], set())
+
+    def test_failed_compaction_keeps_the_change(self):
+        store = self.store(compact_after=1)
+        with mock.patch.object(store, '_write_snapshot', side_effect=OSError('disk full')):
+            with self.assertLogs('utils.blackliststore', 'ERROR'):
+                self.record(store, 'add', 'users', 1)
+        self.assertTrue(store.needs_compaction)
+        self.assertEqual(self.store().load(), ({1}, set()))
+
+    def test_poll_picks_up_changes_of_other_processes(self):
+        store, other = self.store(), self.store()
+        self.assertIsNone(self.loop.run_until_complete(store.poll()))
+        self.record(other, 'add', 'users', 1)
+        self.assertEqual(self.loop.run_until_complete(store.poll()), ({1}, set()))
+        self.assertIsNone(self.loop.run_until_complete(store.poll()))
+
+    def test_own_changes_are_not_reloaded(self):
+        store = self.store()
+        self.record(store, 'add', 'users', 1)
+        self.assertIsNone(self.loop.run_until_complete(store.poll()))
+
+    def test_corrupt_snapshot_raises(self):
+        with open(self.snapshot_path, 'w') as snapshot:
+            snapshot.write('{not json')
+        with self.assertRaises(ValueError): # The cog refuses to run without its blacklist then
+            BlacklistStore(self.snapshot_path, self.journal_path).load()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from utils.matcher import BlacklistMatcher, PatternMatcher
+
+
+class PatternMatcherTest(unittest.TestCase):
+    def test_finds_overlapping_patterns(self):
+        matcher = PatternMatcher(['hers', 'he', 'his'])
+        self.assertEqual(matcher.search('ushers'), 'he')
+        self.assertEqual(matcher.search('this'), 'his')
+        self.assertIsNone(matcher.search('hi'))
+
+    def test_follows_failure_links(self):
+        matcher = PatternMatcher(['abcd', 'bce'])
+        self.assertEqual(matcher.search('abce'), 'bce')
+
+    def test_suffix_pattern_is_reported(self):
+        matcher = PatternMatcher(['abc', 'b'])
+        self.assertEqual(matcher.search('xbx'), 'b')
+
+    def test_changes_apply_to_the_next_search(self):
+        matcher = PatternMatcher(['cat'])
+        self.assertEqual(matcher.search('concatenate'), 'cat')
+        matcher.add('con')
+        self.assertEqual(matcher.search('concatenate'), 'con')
+        matcher.remove('con')
+        matcher.remove('cat')
+        self.assertIsNone(matcher.search('concatenate'))
+        self.assertEqual(len(matcher), 0)
+
+    def test_removed_prefix_keeps_longer_patterns(self):
+        matcher = PatternMatcher(['ab', 'abc'])
+        matcher.remove('ab')
+        self.assertIsNone(matcher.search('abx'))
+        self.assertEqual(matcher.search('xabc'), 'abc')
+
+    def test_empty_pattern_is_ignored(self):
+        matcher = PatternMatcher([''])
+        self.assertEqual(len(matcher), 0)
+        self.assertIsNone(matcher.search('anything'))
+
+
+class BlacklistMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = BlacklistMatcher(['dQw4w9WgXcQ', 'rickroll'])
+
+    def test_exact_video_id(self):
+        self.assertEqual(self.matcher.match({'id': 'dQw4w9WgXcQ', 'title': 'Song'}), 'dQw4w9WgXcQ')
+
+    def test_any_field(self):
+        self.assertEqual(self.matcher.match({'id': 'x', 'title': 'Song', 'description': 'A rickroll, sorry'}), 'rickroll')
+        self.assertEqual(self.matcher.match({'id': 'x', 'uploader': 'rickroll fan'}), 'rickroll')
+
+    def test_missing_fields_are_skipped(self):
+        self.assertIsNone(self.matcher.match({'id': 'x', 'title': None}))
+
+    def test_patterns_never_span_two_fields(self):
+        self.assertIsNone(self.matcher.match({'id': 'x', 'title': 'rick', 'description': 'roll'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+from cogs import music
+from utils.audiocache import AudioCache
+from utils.config import ConfigSnapshot
+
+
+BAKED = -music.loudness.factor_to_gain(music.DEFAULT_VOLUME) # Gain that undoes the level of transcoded files
+
+
+def opus_config(**extra):
+    return ConfigSnapshot({'prefix': '*', 'voice_channel': {}, 'song_length': 1200, 'percentage_skip': 0.5,
+                           'audio_mode': 'opus', 'loudness': {'enabled': True}, **extra})
+
+
+class OpusPassthroughTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop) # Events created by the songs bind to it on older Pythons
+        self.addCleanup(asyncio.set_event_loop, None)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = AudioCache(directory=directory.name)
+        self.filename = os.path.join(directory.name, 'youtube-abc.opus')
+        open(self.filename, 'w').close()
+        patches = [mock.patch.object(music.SongInfo, 'audio_cache', cache),
+                   mock.patch.object(music.SongInfo, 'audio_nodes', None),
+                   mock.patch.object(music.SongInfo, 'opus_bitrate', 96),
+                   mock.patch.object(music.discord, 'FFmpegOpusAudio')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.ffmpeg = music.discord.FFmpegOpusAudio
+        bot = types.SimpleNamespace(loop=self.loop, user=types.SimpleNamespace(id=0), config=opus_config())
+        self.state = music.GuildMusicState(bot, guild_id=1)
+
+    def song(self, gain):
+        info = {'extractor': 'youtube', 'id': 'abc', 'ext': 'opus', 'title': 'Song',
+                '_filename': self.filename}
+        song = music.SongInfo(info, types.SimpleNamespace(id=2), types.SimpleNamespace(id=3))
+        song.local_file = False # Stands for a cached download
+        song.cache_key = 'youtube-abc'
+        music.SongInfo.audio_cache.entries[song.cache_key] = {'filename': song.filename, 'size': 1, 'last_used': 0}
+        music.SongInfo.audio_cache.set_level(song.cache_key, music.DEFAULT_VOLUME) # As transcode_opus writes it
+        if gain is not None:
+            music.SongInfo.audio_cache.set_gain(song.cache_key, gain)
+        return song
+
+    def assert_copied(self):
+        self.assertEqual(self.ffmpeg.call_args.kwargs.get('codec'), 'copy')
+
+    def test_default_volume_matches_pcm_mode(self):
+        self.assertEqual(self.state.volume, 0.5)
+
+    def test_baked_loudness_correction_is_passed_through(self):
+        # normalize_opus stores the gain that undoes the transcode level once the correction is in the file
+        self.state.create_source(self.song(BAKED))
+        self.assert_copied()
+
+    def test_negligible_measured_gain_is_passed_through(self):
+        self.state.create_source(self.song(BAKED + 0.2))
+        self.assert_copied()
+
+    def test_gain_is_applied_at_the_pcm_level(self):
+        self.state.create_source(self.song(-4.0))
+        self.assertIn('volume={:.3f}'.format(0.5 * music.loudness.gain_to_factor(-4.0)), self.ffmpeg.call_args.kwargs['options'])
+
+    def test_unanalysed_file_is_passed_through(self):
+        self.state.create_source(self.song(None))
+        self.assert_copied()
+
+    def test_changed_volume_re_encodes(self):
+        source = self.state.create_source(self.song(BAKED))
+        source.volume = 0.25
+        self.assertNotIn('codec', self.ffmpeg.call_args.kwargs)
+        self.assertIn('volume=0.500', self.ffmpeg.call_args.kwargs['options'])
+
+    def test_set_volume_respawns_the_prepared_source_off_the_loop(self):
+        source = self.state.create_source(self.song(BAKED))
+        self.state.prepared = (None, False, source)
+        threads = []
+        self.ffmpeg.side_effect = lambda *args, **kwargs: threads.append(threading.current_thread()) or mock.DEFAULT
+        self.loop.run_until_complete(self.state.set_volume(0.25))
+        self.assertEqual(source.volume, 0.25)
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(len(threads), 1)
+
+    def test_track_queued_twice_is_analysed_once(self):
+        music.SongInfo.loudness_target = -16.0
+        self.addCleanup(setattr, music.SongInfo, 'loudness_target', None)
+        first, second = self.song(None), self.song(None)
+        for song in (first, second):
+            song.pinned = True # Nothing to pin in this test
+
+
+        async def download_both():
+            await asyncio.gather(first.download(self.loop), second.download(self.loop))
+            await asyncio.sleep(0) # Let the analysis finish
+
+        with mock.patch.object(music.SongInfo, 'analyse_loudness', mock.AsyncMock()) as analyse_loudness:
+            self.loop.run_until_complete(download_both())
+        analyse_loudness.assert_called_once()
+        self.assertEqual(music.SongInfo.analysing, {})
+
+
+class NormalizeOpusTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.lock_path = directory.name + '/track.download'
+        self.marker_path = directory.name + '/track.normalized'
+        patches = [mock.patch.object(music, 'encode_opus'), mock.patch.object(music.loudness, 'measure_gain')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_correction_is_baked_in_at_the_default_volume(self):
+        music.loudness.measure_gain.return_value = -4.0
+        self.assertAlmostEqual(music.normalize_opus('track.opus', -16.0, 96, self.lock_path, self.marker_path), BAKED)
+        music.encode_opus.assert_called_once_with('track.opus', 'track.opus', 96, mock.ANY)
+        self.assertAlmostEqual(music.encode_opus.call_args.args[3], -4.0 - BAKED)
+
+    def test_negligible_correction_is_left_alone(self):
+        music.loudness.measure_gain.return_value = BAKED + 0.2
+        self.assertEqual(music.normalize_opus('track.opus', -16.0, 96, self.lock_path, self.marker_path), BAKED + 0.2)
+        music.encode_opus.assert_not_called()
+
+    def test_corrected_file_is_not_corrected_again(self):
+        music.loudness.measure_gain.return_value = 12.0 # Capped, the corrected file still measures too quiet
+        music.normalize_opus('track.opus', -16.0, 96, self.lock_path, self.marker_path)
+        self.assertAlmostEqual(music.normalize_opus('track.opus', -16.0, 96, self.lock_path, self.marker_path), BAKED)
+        music.encode_opus.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from cogs import music
+from utils import executor
+
+
+class FakeSong:
+    """Stands for a SongInfo, downloads and resolves only finish when the test says so."""
+
+    def __init__(self, name, resolved=True):
+        self.name = name
+        self.resolved = resolved
+        self.downloaded = asyncio.Event()
+        self.released = False
+        self.priorities = []
+        self.resolving = 0
+
+    def release(self):
+        self.released = True
+
+    async def download(self, loop, priority):
+        self.priorities.append(priority)
+        await self.downloaded.wait()
+
+    async def resolve(self, loop, priority):
+        self.resolving += 1
+        self.resolved = True
+
+    def __str__(self):
+        return self.name
+
+
+class PlaylistTest(unittest.TestCase):
+    def setUp(self):
+        self.playlist = music.Playlist(maxsize=3)
+        self.songs = [FakeSong(name) for name in 'abc']
+        self.handles = [self.playlist.add_song(song) for song in self.songs]
+
+    def test_handles_are_stable_and_stored_on_the_song(self):
+        self.assertEqual(len(set(self.handles)), 3)
+        self.assertEqual([song.handle for song in self.songs], self.handles)
+        self.playlist.remove(self.handles[0])
+        self.assertEqual(self.playlist.handle_at(0), self.handles[1])
+
+    def test_handle_at_rejects_out_of_range_positions(self):
+        self.assertEqual(self.playlist.handle_at(2), self.handles[2])
+        for idx in (-1, 3):
+            with self.assertRaises(IndexError):
+                self.playlist.handle_at(idx)
+
+    def test_remove_releases_the_song(self):
+        self.assertIs(self.playlist.remove(self.handles[1]), self.songs[1])
+        self.assertTrue(self.songs[1].released)
+        self.assertEqual(list(self.playlist), [self.songs[0], self.songs[2]])
+        with self.assertRaises(KeyError):
+            self.playlist.remove(self.handles[1])
+
+    def test_take_keeps_the_song_pinned(self):
+        self.assertIs(self.playlist.take(self.handles[0]), self.songs[0])
+        self.assertFalse(self.songs[0].released)
+        self.assertIsNone(self.playlist.take(self.handles[0]))
+
+    def test_get_song_pops_in_order(self):
+        self.assertEqual([self.playlist.get_song() for _ in range(3)], self.songs)
+        with self.assertRaises(asyncio.QueueEmpty):
+            self.playlist.get_song()
+
+    def test_full_playlist_rejects_songs(self):
+        self.assertTrue(self.playlist.full())
+        with self.assertRaises(asyncio.QueueFull):
+            self.playlist.add_song(FakeSong('d'))
+
+    def test_render_follows_removals_and_refreshes(self):
+        self.assertIn('1. a\n2. b\n3. c\n', str(self.playlist))
+        self.playlist.remove(self.handles[0])
+        self.songs[1].name = 'resolved b'
+        self.playlist.refresh(self.songs[1])
+        self.assertIn('1. resolved b\n2. c\n', str(self.playlist))
+        self.assertIn('Total songs in playlist: 2', str(self.playlist))
+
+
+class FreeSlotsTest(unittest.TestCase):
+    def test_counts_the_remaining_slots(self):
+        playlist = music.Playlist(maxsize=3)
+        playlist.add_song(FakeSong('a'))
+        self.assertEqual(playlist.free_slots(), 2)
+
+    def test_never_goes_below_zero(self):
+        playlist = music.Playlist(maxsize=3)
+        for name in 'abc':
+            playlist.add_song(FakeSong(name))
+        playlist.maxsize = 1 # Lowered by a config reload
+        self.assertEqual(playlist.free_slots(), 0)
+
+    def test_size_zero_is_unlimited(self):
+        playlist = music.Playlist(maxsize=0)
+        self.assertIsNone(playlist.free_slots())
+        playlist.add_song(FakeSong('a'))
+        self.assertIsNone(playlist.free_slots())
+        self.assertFalse(playlist.full())
+
+
+class ExtractFlatTest(unittest.TestCase):
+    def setUp(self):
+        entries = [{'url': str(idx), 'id': str(idx), 'title': str(idx)} for idx in range(5)]
+        ytdl = mock.Mock()
+        ytdl.extract_info.return_value = {'entries': iter(entries[:2] + [None] + entries[2:])}
+        patch = mock.patch.object(music.SongInfo, 'get_ytdl', return_value=ytdl)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_limit(self):
+        self.assertEqual([entry['id'] for entry in music.extract_flat('url', 2)], ['0', '1'])
+
+    def test_no_limit_reads_every_entry(self):
+        self.assertEqual(len(music.extract_flat('url', music.Playlist(maxsize=0).free_slots())), 5)
+
+
+class PrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop) # Events created by the songs bind to it on older Pythons
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.playlist = music.Playlist(maxsize=0)
+        self.prefetcher = music.Prefetcher(self.playlist, self.loop, window=2, resolve_ahead=1)
+        self.addCleanup(self.settle, self.prefetcher.cancel_all)
+
+    def settle(self, action=None):
+        if action is not None:
+            action()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def add(self, *songs):
+        for song in songs:
+            self.playlist.add_song(song)
+
+    def test_only_the_window_downloads(self):
+        songs = [FakeSong(name) for name in 'abcd']
+        self.add(*songs)
+        self.settle(self.prefetcher.refill)
+        self.assertEqual([song.priorities for song in songs], [[executor.NEXT_UP], [executor.PREFETCH], [], []])
+        self.assertEqual(self.prefetcher.status()['in_flight'], 2)
+
+    def test_consumed_songs_make_room_for_the_next(self):
+        songs = [FakeSong(name) for name in 'abc']
+        self.add(*songs)
+        self.settle(self.prefetcher.refill)
+        songs[0].downloaded.set()
+        self.playlist.get_song()
+        self.settle(self.prefetcher.refill)
+        self.assertEqual(songs[2].priorities, [executor.PREFETCH])
+        self.assertNotIn(songs[0], self.prefetcher.tasks)
+
+    def test_removed_song_is_cancelled(self):
+        songs = [FakeSong(name) for name in 'abc']
+        self.add(*songs)
+        self.settle(self.prefetcher.refill)
+        task = self.prefetcher.tasks[songs[1]]
+        self.playlist.remove(songs[1].handle)
+        self.settle(lambda: (self.prefetcher.cancel(songs[1]), self.prefetcher.refill()))
+        self.assertTrue(task.cancelled())
+        self.assertEqual(songs[2].priorities, [executor.PREFETCH])
+
+    def test_placeholders_past_the_window_are_resolved_and_checked(self):
+        songs = [FakeSong(name) for name in 'ab'] + [FakeSong('c', resolved=False), FakeSong('d', resolved=False)]
+        self.add(*songs)
+        self.prefetcher.check = mock.AsyncMock()
+        self.settle(self.prefetcher.refill)
+        self.assertEqual([song.resolving for song in songs], [0, 0, 1, 0]) # Only resolve_ahead entries past the window
+        self.prefetcher.check.assert_awaited_once_with(songs[2])
+        self.assertEqual(songs[2].priorities, [])
+
+    def test_failed_check_unblocks_the_song(self):
+        songs = [FakeSong(name) for name in 'ab'] + [FakeSong('c', resolved=False)]
+        self.add(*songs)
+        error = music.MusicError('blacklisted')
+        self.prefetcher.check = mock.AsyncMock(side_effect=error)
+        self.settle(self.prefetcher.refill)
+        self.assertIs(songs[2].error, error)
+        self.assertTrue(songs[2].downloaded.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
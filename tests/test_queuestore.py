@@ -0,0 +1,111 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from utils.queuestore import QueueStore, apply_event, empty_state
+
+GUILD = 1234
+
+
+class ApplyEventTest(unittest.TestCase):
+    def test_playing_moves_the_entry_out_of_the_queue(self):
+        state = empty_state()
+        for event in (['add', 0, {'title': 'a'}], ['add', 1, {'title': 'b'}], ['position', 12.5], ['play', 0, 99]):
+            apply_event(state, event)
+        self.assertEqual(state['current'], {'title': 'a'})
+        self.assertEqual(state['queue'], [[1, {'title': 'b'}]])
+        self.assertEqual((state['voice_channel'], state['position']), (99, 0.0))
+
+    def test_remove_and_clear(self):
+        state = empty_state()
+        for event in (['add', 0, {}], ['add', 1, {}], ['remove', 0]):
+            apply_event(state, event)
+        self.assertEqual(state['queue'], [[1, {}]])
+        apply_event(state, ['clear'])
+        self.assertEqual(state['queue'], [])
+
+    def test_stop_forgets_the_current_track(self):
+        state = empty_state()
+        for event in (['add', 0, {}], ['play', 0, 99], ['settings', {'volume': 0.3}], ['stop']):
+            apply_event(state, event)
+        self.assertIsNone(state['current'])
+        self.assertEqual(state['volume'], 0.3)
+
+
+class QueueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def store(self, compact_after=200):
+        store = QueueStore(self.directory, compact_after=compact_after)
+        return store, store.load_all()
+
+    def record(self, store, *events):
+        async def record_and_close():
+            for event in events:
+                store.record(GUILD, *event)
+            await store.close()
+        self.loop.run_until_complete(record_and_close())
+
+    def test_queue_is_resumed_after_a_restart(self):
+        store, _ = self.store()
+        self.record(store, ('add', 0, {'title': 'a'}), ('add', 1, {'title': 'b'}), ('play', 0, 99), ('position', 30.0))
+        _, saved = self.store()
+        self.assertEqual(saved[GUILD]['current'], {'title': 'a'})
+        self.assertEqual(saved[GUILD]['queue'], [[1, {'title': 'b'}]])
+        self.assertEqual(saved[GUILD]['position'], 30.0)
+
+    def test_compaction_writes_a_snapshot_and_empties_the_journal(self):
+        store, _ = self.store(compact_after=2)
+        self.record(store, ('add', 0, {}), ('add', 1, {}))
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, '{}.journal'.format(GUILD))), 0)
+        self.record(store, ('add', 2, {}))
+        store, saved = self.store()
+        self.assertEqual([handle for handle, _ in saved[GUILD]['queue']], [0, 1, 2])
+        self.assertEqual(store.journal_lengths[GUILD], 1)
+
+    def test_stopped_guild_is_not_resumed(self):
+        store, _ = self.store()
+        self.record(store, ('add', 0, {}), ('play', 0, 99), ('stop',))
+        _, saved = self.store()
+        self.assertNotIn(GUILD, saved)
+
+    def test_torn_event_is_dropped_and_cut_off(self):
+        store, _ = self.store()
+        self.record(store, ('add', 0, {}))
+        journal_path = os.path.join(self.directory, '{}.journal'.format(GUILD))
+        with open(journal_path, 'a') as journal:
+            journal.write('["add", 1')
+        with self.assertLogs('utils.jsonfiles', 'WARNING'):
+            store, saved = self.store()
+        self.assertEqual(saved[GUILD]['queue'], [[0, {}]])
+        self.record(store, ('add', 2, {}))
+        _, saved = self.store()
+        self.assertEqual([handle for handle, _ in saved[GUILD]['queue']], [0, 2])
+
+    def test_other_workers_guilds_are_not_loaded(self):
+        store, _ = self.store()
+        self.record(store, ('add', 0, {}))
+        self.assertEqual(QueueStore(self.directory).load_all(owned=lambda guild_id: guild_id != GUILD), {})
+
+    def test_close_writes_events_recorded_after_the_flush_started(self):
+        store, _ = self.store()
+
+        async def record_while_flushing():
+            store.record(GUILD, 'add', 0, {})
+            await asyncio.sleep(0) # The flush task took the first event
+            store.record(GUILD, 'add', 1, {})
+            await store.close()
+
+        self.loop.run_until_complete(record_while_flushing())
+        _, saved = self.store()
+        self.assertEqual([handle for handle, _ in saved[GUILD]['queue']], [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
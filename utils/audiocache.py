@@ -0,0 +1,285 @@
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+from utils.filelock import fcntl, file_lock
+from utils.jsonfiles import write_atomic
+
+INDEX_NAME = 'index.json'
+IGNORED_SUFFIXES = ('.part', '.ytdl', '.tmp')
+OPUS_SUFFIX = '.opus'
+LOCK_DIRECTORY = '.locks'
+PIN_RETRY = 0.05 # Seconds between attempts to pin a file another process is evicting
+
+
+class AudioCache:
+    """Shared on-disk cache for downloaded tracks.
+
+    Entries are keyed by ``<extractor>-<id>`` and kept in LRU order. Files that are
+    queued or playing are pinned through a refcount and are never evicted.
+
+    Several processes (cluster workers) can share one cache directory: pins are also
+    held as shared file locks that evictions check, and every maintenance run merges
+    the stored index with what other processes downloaded or evicted.
+    """
+
+    def __init__(self, directory='audio-cache', max_bytes=2 * 1024 ** 3, max_files=500):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self.index_lock_path = os.path.join(directory, LOCK_DIRECTORY, INDEX_NAME + '.lock')
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.entries = collections.OrderedDict()  # key -> {'filename', 'size', 'last_used'}, plus 'gain' and 'level' once known
+        self.refcounts = collections.Counter()
+        self._pins = {} # key -> descriptor holding the shared pin lock
+        self._pinning = {} # key -> task waiting for an eviction in another process to let go of the pin lock
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._write_lock = threading.Lock() # Maintenance of several guilds can flush at once
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get('audio_cache', {})
+        return cls(directory=cache_config.get('directory', 'audio-cache'),
+                   max_bytes=cache_config.get('max_megabytes', 2048) * 1024 ** 2,
+                   max_files=cache_config.get('max_files', 500))
+
+    @staticmethod
+    def key_for(filename):
+        """Cache keys are the file stem, which the download template sets to ``<extractor>-<id>``."""
+        return os.path.basename(filename).rsplit('.', 1)[0]
+
+    def load(self):
+        """Rebuilds the index from the stored index file and a single directory scan."""
+        os.makedirs(os.path.join(self.directory, LOCK_DIRECTORY), exist_ok=True)
+        stored = self._read_index()
+
+        found = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith('.') or entry.name == INDEX_NAME:
+                    continue
+                if entry.name.endswith(IGNORED_SUFFIXES):
+                    continue
+                key = self.key_for(entry.name)
+                filename = os.path.join(self.directory, entry.name)
+                if key in found:
+                    # Leftover source of an interrupted Opus transcode, keep the transcoded file
+                    if not filename.endswith(OPUS_SUFFIX):
+                        os.remove(filename)
+                        continue
+                    os.remove(found[key]['filename'])
+                stat = entry.stat()
+                found[key] = {
+                    'filename': filename,
+                    'size': stat.st_size,
+                    'last_used': stored.get(key, {}).get('last_used', stat.st_mtime),
+                }
+
+        self.entries.clear()
+        self.total_bytes = 0
+        for key, entry in sorted(found.items(), key=lambda x: x[1]['last_used']):
+            self.entries[key] = {**stored.get(key, {}), **entry}
+            self.total_bytes += entry['size']
+
+    def lock_path(self, key, kind):
+        """Path of a lock or marker file of ``key``, they are removed along with the evicted file."""
+        return os.path.join(self.directory, LOCK_DIRECTORY, '{}.{}'.format(key, kind))
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, entries):
+        """Writes an index snapshot atomically. Blocking, run it in an executor."""
+        write_atomic(self.index_path, entries, durable=False) # Rebuilt from the directory if lost
+
+    def lookup(self, key):
+        """Returns the cached filename for ``key`` and marks it as recently used, or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is None or not os.path.exists(entry['filename']):
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry['last_used'] = time.time()
+        self.entries.move_to_end(key)
+        return entry['filename']
+
+    def add(self, key, filename):
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        previous = self.entries.get(key, {})
+        if previous:
+            self.total_bytes -= previous['size']
+        self.entries[key] = {**previous, 'filename': filename, 'size': size, 'last_used': time.time()}
+        self.entries.move_to_end(key)
+        self.total_bytes += size
+
+    def get_gain(self, key):
+        """Returns the stored loudness correction in dB, or None if the track wasn't analysed yet."""
+        entry = self.entries.get(key)
+        return entry.get('gain') if entry else None
+
+    def set_gain(self, key, gain):
+        if key in self.entries:
+            self.entries[key]['gain'] = gain
+
+    def get_level(self, key):
+        """Returns the volume factor the file was written at, 1.0 unless it was transcoded at a lower level."""
+        entry = self.entries.get(key)
+        return entry.get('level', 1.0) if entry else 1.0
+
+    def set_level(self, key, level):
+        if key in self.entries:
+            self.entries[key]['level'] = level
+
+    def _pin(self, key):
+        """Takes the shared lock that evictions in other processes check before deleting a file.
+
+        Never blocks, returns None while an eviction holds the exclusive lock.
+        """
+        path = self.lock_path(key, 'pin')
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd) # Unlinked by an eviction since we opened it, lock the new file
+
+    async def acquire(self, key):
+        """Pins ``key``, waiting without blocking the loop if another process is evicting it right now.
+
+        Concurrent acquirers of a key all wait for the same pin. The refcount stays taken when the
+        wait is cancelled, the caller still releases it.
+        """
+        self.refcounts[key] += 1
+        if fcntl is None or key in self._pins:
+            return
+        pending = self._pinning.get(key)
+        if pending is None or pending.done():
+            pending = self._pinning[key] = asyncio.ensure_future(self._pin_when_free(key))
+            pending.add_done_callback(lambda task: self._pinning.pop(key) if self._pinning.get(key) is task else None)
+        await asyncio.shield(pending)
+
+    async def _pin_when_free(self, key):
+        fd = self._pin(key)
+        while fd is None:
+            await asyncio.sleep(PIN_RETRY)
+            fd = self._pin(key)
+        if self.refcounts[key] > 0:
+            self._pins[key] = fd
+        else:
+            os.close(fd) # Released while we waited
+
+    def release(self, key):
+        self.refcounts[key] -= 1
+        if self.refcounts[key] <= 0:
+            del self.refcounts[key]
+            fd = self._pins.pop(key, None)
+            if fd is not None:
+                os.close(fd)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        return entry
+
+    def evict(self):
+        """Drops least recently used, unpinned entries until the cache fits its budget.
+
+        Only the in-memory index is touched, the returned (key, entry) pairs still have to be removed.
+        """
+        evicted = []
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes and len(self.entries) <= self.max_files:
+                break
+            if self.refcounts[key] > 0:
+                continue
+            evicted.append((key, self._drop(key)))
+        return evicted
+
+    def _remove(self, key, filename):
+        """Deletes an evicted file unless another process has it pinned. Returns whether it was deleted."""
+        if fcntl is None:
+            with contextlib.suppress(OSError):
+                os.remove(filename)
+            return True
+        path = self.lock_path(key, 'pin')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False # Queued or playing in another process
+            for stale in (filename, self.lock_path(key, 'download'), self.lock_path(key, 'normalized'), path):
+                with contextlib.suppress(OSError):
+                    os.remove(stale)
+            return True
+        finally:
+            os.close(fd)
+
+    def _flush(self, evicted, entries):
+        """Removes evicted files and merges the index with the stored one. Returns the merged index."""
+        entries = dict(entries)
+        with self._write_lock, file_lock(self.index_lock_path):
+            removed = set()
+            for key, entry in evicted:
+                if self._remove(key, entry['filename']):
+                    removed.add(key)
+                else:
+                    entries[key] = entry
+            # Pick up downloads of other processes, forget files they evicted
+            stored = self._read_index()
+            for key, entry in stored.items():
+                if key in entries:
+                    entries[key] = {**entry, **entries[key], 'last_used': max(entry['last_used'], entries[key]['last_used'])}
+                elif key not in removed:
+                    entries[key] = entry
+            entries = {key: entry for key, entry in entries.items() if os.path.exists(entry['filename'])}
+            self.write_index(entries)
+        return entries
+
+    def _reconcile(self, known, merged):
+        changed = False
+        for key in known:
+            if key not in merged and key in self.entries and self.refcounts[key] <= 0:
+                self._drop(key)
+        for key, entry in merged.items():
+            current = self.entries.get(key)
+            if current is not None:
+                current['last_used'] = max(current['last_used'], entry['last_used'])
+                for field in ('gain', 'level'):
+                    if field in entry:
+                        current.setdefault(field, entry[field])
+            elif key not in known: # Dropped meanwhile otherwise
+                self.entries[key] = dict(entry)
+                self.total_bytes += entry['size']
+                changed = True
+        if changed:
+            self.entries = collections.OrderedDict(sorted(self.entries.items(), key=lambda item: item[1]['last_used']))
+
+    async def maintain(self, loop):
+        """Evicts over-budget entries and persists the index without blocking the loop."""
+        evicted = self.evict()
+        known = dict(self.entries)
+        merged = await loop.run_in_executor(None, self._flush, evicted, known)
+        self._reconcile(known, merged)
@@ -0,0 +1,174 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.connection import Client, Listener
+
+FRAME_LENGTH = 0.02 # Seconds of audio per Opus packet
+START_TIMEOUT = 10 # Seconds to wait for a freshly spawned node to listen
+
+logger = logging.getLogger('musicbot2.audionode')
+
+
+class NodeStream:
+    """One track playing on an audio node, driven by the commands of a single connection.
+
+    Commands are tuples: ``('play', options)`` answers with None or an error message,
+    ``('read',)`` answers with the next Opus packet (empty at the end of the track),
+    ``('volume', value)``, ``('seek', seconds)`` and ``('close',)`` have no answer.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.source = None
+        self.encoder = None
+        self.options = None
+
+    def run(self):
+        try:
+            while True:
+                command, *args = self.conn.recv()
+                if command == 'close':
+                    break
+                getattr(self, 'on_' + command)(*args)
+        except (EOFError, OSError):
+            pass # The bot went away, nothing to answer to
+        except Exception:
+            logger.exception('Audio node stream failed')
+        finally:
+            self.cleanup()
+            self.conn.close()
+
+    def _spawn(self, position):
+        import discord
+        before_options = self.options['before_options']
+        if position:
+            before_options += ' -ss {:.2f}'.format(position)
+        source = discord.FFmpegPCMAudio(self.options['location'], before_options=before_options, options=self.options['options'])
+        return discord.PCMVolumeTransformer(source, volume=self.options['volume'])
+
+    def on_play(self, options):
+        import discord
+        self.options = options
+        try:
+            self.encoder = discord.opus.Encoder()
+            self.encoder.set_bitrate(options['bitrate'])
+            self.source = self._spawn(options['start'])
+        except Exception as e:
+            self.conn.send('{}: {}'.format(type(e).__name__, e))
+        else:
+            self.conn.send(None)
+
+    def on_read(self):
+        pcm = self.source.read()
+        self.conn.send_bytes(self.encoder.encode(pcm, self.encoder.SAMPLES_PER_FRAME) if pcm else b'')
+
+    def on_volume(self, value):
+        self.options['volume'] = value
+        self.source.volume = value
+
+    def on_seek(self, position):
+        old_source, self.source = self.source, self._spawn(position)
+        old_source.cleanup()
+
+    def cleanup(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+
+def serve(address, authkey, ready):
+    """Runs an audio node, one thread per connected stream."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s:%(levelname)s:%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    if os.path.exists(address):
+        os.remove(address) # Left behind by a node that died
+    listener = Listener(address, authkey=authkey)
+    ready.set()
+    while True:
+        try:
+            conn = listener.accept()
+        except (EOFError, OSError, multiprocessing.AuthenticationError) as e:
+            logger.warning('Rejected audio node connection: %s', e)
+            continue
+        threading.Thread(target=NodeStream(conn).run, daemon=True).start()
+
+
+class AudioNode:
+    def __init__(self, context, address, authkey):
+        self.context = context
+        self.address = address
+        self.authkey = authkey
+        self.process = None
+        self.ready = None
+        self.streams = 0
+
+    def start(self):
+        self.ready = self.context.Event()
+        self.process = self.context.Process(target=serve, args=(self.address, self.authkey, self.ready),
+                                            name='musicbot-audio-node', daemon=True)
+        self.process.start()
+
+    def connect(self):
+        if not self.process.is_alive():
+            logger.warning('Audio node %s exited with code %s, restarting', self.address, self.process.exitcode)
+            self.start()
+        if not self.ready.wait(START_TIMEOUT):
+            raise RuntimeError('Audio node {} did not start'.format(self.address))
+        return Client(self.address, authkey=self.authkey)
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+
+
+class AudioNodePool:
+    """Local processes that own FFmpeg, volume and Opus encoding for the voice clients.
+
+    The player threads in the bot only pass the finished packets on, which keeps the
+    audio work from competing with the event loop for the GIL. Every track gets its
+    own connection to the node with the fewest streams. Dead nodes are restarted
+    the next time a track is assigned to them.
+    """
+
+    def __init__(self, processes=1):
+        self.directory = tempfile.mkdtemp(prefix='musicbot-nodes-')
+        authkey = os.urandom(32)
+        context = multiprocessing.get_context('spawn')
+        self.nodes = [AudioNode(context, os.path.join(self.directory, 'node{}.sock'.format(idx)), authkey)
+                      for idx in range(processes)]
+        self._lock = threading.Lock() # Streams are released from the player threads
+
+    @classmethod
+    def from_config(cls, config):
+        processes = config.get('audio_nodes', {}).get('processes', 0)
+        if not processes:
+            return None
+        return cls(processes=processes)
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+
+    def open(self):
+        """Returns the least loaded node and a new connection to it."""
+        with self._lock:
+            node = min(self.nodes, key=lambda node: node.streams)
+            node.streams += 1
+        try:
+            return node, node.connect()
+        except Exception:
+            self.release(node)
+            raise
+
+    def release(self, node):
+        with self._lock:
+            node.streams -= 1
+
+    def close(self):
+        for node in self.nodes:
+            node.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
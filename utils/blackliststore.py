@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import os
+
+from utils.filelock import file_lock
+from utils.jsonfiles import replay_journal, write_atomic
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('users', 'videos')
+
+
+class BlacklistStore:
+    """Crash safe storage for the blacklist.
+
+    The state lives in a snapshot (the familiar ``blacklist.json``, so an existing
+    file is picked up as is) plus an append-only journal of changes. Every change is
+    appended and fsynced off the event loop, and once the journal holds
+    ``compact_after`` entries it is folded into a new, atomically replaced snapshot.
+
+    Writes hold a file lock, so several processes (cluster workers) can share the
+    files; ``refresh`` picks up the changes the other processes made.
+    """
+
+    def __init__(self, snapshot_path='blacklist.json', journal_path='blacklist.journal', compact_after=100):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_after = compact_after
+        self.state = {kind: set() for kind in KINDS}
+        self.journal_length = 0
+        self.lock_path = journal_path + '.lock'
+        self.signature = None # Snapshot and journal file stats as of the last load
+        self._journal = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        store_config = config.get('blacklist', {})
+        return cls(snapshot_path=store_config.get('snapshot', 'blacklist.json'),
+                   journal_path=store_config.get('journal', 'blacklist.journal'),
+                   compact_after=store_config.get('compact_after', 100))
+
+    def load(self):
+        """Reads the snapshot and replays the journal on top of it. Returns the (users, videos) sets."""
+        with file_lock(self.lock_path):
+            self._replay()
+            self.signature = self._signature()
+        return set(self.state['users']), set(self.state['videos'])
+
+    def refresh(self):
+        """Reloads the state if another process changed it. Returns the (users, videos) sets, or None if unchanged.
+
+        Blocking, run it in an executor.
+        """
+        if self._signature() == self.signature:
+            return None
+        return self.load()
+
+    async def poll(self):
+        """Runs ``refresh`` off the event loop, never at the same time as ``record``.
+
+        A change recorded while the files are read would otherwise be missing from the
+        returned sets. Callers must swap them in before awaiting anything else.
+        """
+        async with self._lock:
+            return await asyncio.get_event_loop().run_in_executor(None, self.refresh)
+
+    def _signature(self):
+        signature = []
+        for path in (self.snapshot_path, self.journal_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signature.append(None)
+            else:
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def _replay(self):
+        try:
+            with open(self.snapshot_path) as snapshot:
+                stored = json.load(snapshot)
+        except FileNotFoundError:
+            stored = {}
+        self.state = {kind: set(stored.get(kind, [])) for kind in KINDS}
+        self.journal_length = replay_journal(self.journal_path, lambda entry: self._apply(*entry))
+
+    def _apply(self, op, kind, value):
+        if op == 'add':
+            self.state[kind].add(value)
+        else:
+            self.state[kind].discard(value)
+
+    def _append(self, line):
+        with file_lock(self.lock_path):
+            unchanged = self._signature() == self.signature
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            if unchanged: # Otherwise keep the old signature so refresh picks up the other process' changes
+                self.signature = self._signature()
+
+    def _write_snapshot(self):
+        with file_lock(self.lock_path):
+            # Other processes may have appended to the journal since we last read it
+            self._replay()
+            write_atomic(self.snapshot_path, {kind: sorted(self.state[kind], key=str) for kind in KINDS})
+            # Everything in the journal is now part of the snapshot
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            open(self.journal_path, 'w').close()
+            self.journal_length = 0
+
+    @property
+    def needs_compaction(self):
+        return self.journal_length >= self.compact_after
+
+    async def record(self, op, kind, value):
+        """Durably records an ``add`` or ``remove`` of ``value`` in ``users`` or ``videos``.
+
+        Raises OSError if the change could not be written, the state is left untouched then.
+        """
+        loop = asyncio.get_event_loop()
+        async with self._lock:
+            await loop.run_in_executor(None, self._append, json.dumps([op, kind, value]) + '\n')
+            self._apply(op, kind, value)
+            self.journal_length += 1
+            if self.needs_compaction:
+                try:
+                    await loop.run_in_executor(None, self._write_snapshot)
+                except OSError: # The change itself is safe in the journal, compaction is retried later
+                    logger.exception('Could not compact the blacklist')
+
+    async def compact(self):
+        async with self._lock:
+            await asyncio.get_event_loop().run_in_executor(None, self._write_snapshot)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import numbers
+import os
+
+import yaml
+
+logger = logging.getLogger('musicbot2.config')
+
+# Sections read once when the bot or a cog starts, changing them needs a restart
+RESTART_KEYS = ('autoload_cogs', 'audio_cache', 'metadata_cache', 'extractor_pool', 'audio_mode', 'opus_bitrate', 'audio_nodes',
+                'loudness', 'blacklist', 'outbound', 'queue_state', 'library', 'metrics', 'watchdog', 'cluster', 'config_reload')
+SECTIONS = ('audio_cache', 'metadata_cache', 'extractor_pool', 'audio_nodes', 'loudness', 'blacklist', 'outbound', 'queue_state',
+            'library', 'metrics', 'watchdog', 'profiler', 'cluster', 'config_reload')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _check(condition, message, *args):
+    if not condition:
+        raise ConfigError(message.format(*args))
+
+
+def validate(data):
+    """Raises ConfigError if the settings can't be used."""
+    _check(isinstance(data, dict), 'The config must be a mapping')
+    _check(isinstance(data.get('prefix'), str) and data['prefix'], 'prefix must be a non-empty string')
+    _check(isinstance(data.get('song_length'), numbers.Real) and data['song_length'] > 0, 'song_length must be a positive number')
+    _check(isinstance(data.get('percentage_skip'), numbers.Real) and 0 <= data['percentage_skip'] <= 1,
+           'percentage_skip must be between 0 and 1')
+    _check(isinstance(data.get('voice_channel'), dict), 'voice_channel must map server IDs to lists of channel IDs')
+    for guild_id, channel_ids in data['voice_channel'].items():
+        _check(isinstance(guild_id, int), 'voice_channel: {!r} is not a server ID', guild_id)
+        _check(isinstance(channel_ids, list) and all(isinstance(channel_id, int) for channel_id in channel_ids),
+               'voice_channel: the channels of server {} must be a list of channel IDs', guild_id)
+    _check(isinstance(data.get('super_power_roles', []), list), 'super_power_roles must be a list of role names')
+    _check(isinstance(data.get('autoload_cogs', []), list), 'autoload_cogs must be a list of cog names')
+    _check(isinstance(data.get('playlist_size', 50), int) and data.get('playlist_size', 50) >= 0,
+           'playlist_size must be a whole number, 0 for no limit')
+    for section in SECTIONS:
+        _check(isinstance(data.get(section, {}), dict), '{} must be a mapping', section)
+
+
+class ConfigSnapshot(dict):
+    """The validated settings, with the lookups commands need precomputed.
+
+    Snapshots are never modified. A reload builds a new one and swaps ``bot.config``,
+    so readers always see one consistent version without any locking.
+    """
+
+    def __init__(self, data):
+        validate(data)
+        super().__init__(data)
+        self.voice_channels = {guild_id: frozenset(channel_ids) for guild_id, channel_ids in data['voice_channel'].items()}
+        self.super_power_roles = frozenset(data.get('super_power_roles', ()))
+        self.owner_role = data.get('owner_role')
+        self.song_length = data['song_length']
+        self.percentage_skip = data['percentage_skip']
+        self.playlist_size = data.get('playlist_size', 50)
+
+    @classmethod
+    def load(cls, path='config.yml'):
+        with open(path) as config_file:
+            return cls(yaml.safe_load(config_file))
+
+
+class ConfigWatcher:
+    """Reloads config.yml when it changes and dispatches ``on_config_reload(old, new)``.
+
+    An invalid file is logged and ignored, the bot keeps running on the last good snapshot.
+    """
+
+    def __init__(self, bot, path='config.yml', interval=5):
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+        self.signature = self._signature()
+
+    @classmethod
+    def from_config(cls, bot, path='config.yml'):
+        return cls(bot, path=path, interval=bot.config.get('config_reload', {}).get('interval', 5))
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = self._signature()
+            if signature != self.signature:
+                self.signature = signature
+                await self.reload()
+
+    async def reload(self):
+        """Returns the error message if the file could not be used."""
+        try:
+            snapshot = await self.bot.loop.run_in_executor(None, ConfigSnapshot.load, self.path)
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            logger.error('Not reloading %s: %s', self.path, e)
+            return str(e)
+        old, self.bot.config = self.bot.config, snapshot
+        changed = sorted(key for key in set(old) | set(snapshot) if old.get(key) != snapshot.get(key))
+        logger.info('Reloaded %s, changed: %s', self.path, ', '.join(changed) or 'nothing')
+        needs_restart = [key for key in changed if key in RESTART_KEYS]
+        if needs_restart:
+            logger.warning('Changes to %s only apply after a restart', ', '.join(needs_restart))
+        self.bot.dispatch('config_reload', old, snapshot)
+        return None
@@ -0,0 +1,102 @@
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import itertools
+
+# Priority classes, lower runs first
+NEXT_UP = 0
+INTERACTIVE = 1
+PREFETCH = 2
+
+
+class ExtractorPool:
+    """Bounded executor for extractor and download jobs.
+
+    Jobs wait in a priority queue until one of ``workers`` slots frees up, so a burst
+    of prefetches can never starve the song that is about to play. Every guild is
+    additionally capped at ``per_guild`` running jobs, next-up jobs excepted.
+
+    With ``use_processes`` the jobs run in worker processes, which sidesteps the GIL
+    for youtube_dl parsing but requires picklable, module level functions.
+    """
+
+    def __init__(self, workers=4, use_processes=False, per_guild=2):
+        self.workers = workers
+        self.per_guild = per_guild
+        if use_processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='extractor')
+        self.active = 0
+        self._pending = []
+        self._counter = itertools.count()
+        self._guild_limits = {} # guild id -> semaphore, dropped once the guild has no running or waiting jobs
+        self._guild_jobs = collections.Counter()
+
+    @classmethod
+    def from_config(cls, config):
+        pool_config = config.get('extractor_pool', {})
+        return cls(workers=pool_config.get('workers', 4),
+                   use_processes=pool_config.get('processes', False),
+                   per_guild=pool_config.get('per_guild', 2))
+
+    @property
+    def queued(self):
+        return sum(1 for _, _, waiter in self._pending if not waiter.done())
+
+    def _dispatch(self):
+        while self.active < self.workers and self._pending:
+            _, _, waiter = heapq.heappop(self._pending)
+            if waiter.done(): # Cancelled while queued
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    async def _acquire(self, priority):
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._pending, (priority, next(self._counter), waiter))
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release() # We got a slot right as we were cancelled
+            raise
+
+    async def _run(self, priority, func, args, started):
+        await self._acquire(priority)
+        if started is not None:
+            started.set()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self._release()
+
+    async def run(self, priority, func, *args, guild_id=None, started=None):
+        """Runs ``func(*args)`` in the pool once a slot is available for its priority class.
+
+        ``started`` is an optional asyncio.Event, set when the job leaves the queue. Cancelling
+        before that drops the job, afterwards the job itself can't be stopped anymore.
+        """
+        if guild_id is None or priority == NEXT_UP:
+            return await self._run(priority, func, args, started)
+        limit = self._guild_limits.get(guild_id)
+        if limit is None:
+            limit = self._guild_limits[guild_id] = asyncio.Semaphore(self.per_guild)
+        self._guild_jobs[guild_id] += 1
+        try:
+            async with limit:
+                return await self._run(priority, func, args, started)
+        finally:
+            self._guild_jobs[guild_id] -= 1
+            if not self._guild_jobs[guild_id]:
+                del self._guild_jobs[guild_id]
+                del self._guild_limits[guild_id]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
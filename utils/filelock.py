@@ -0,0 +1,17 @@
+import contextlib
+
+try:
+    import fcntl
+except ImportError: # Windows, where state can't be shared between processes
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """Holds a lock on ``path`` across processes. Blocking, use it off the event loop."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
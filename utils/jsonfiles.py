@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, data, durable=True, **dump_options):
+    """Replaces ``path`` with ``data`` as JSON, readers see either the old or the new file.
+
+    ``durable`` fsyncs the new file before it replaces the old one, leave it off for files
+    that can be rebuilt. Blocking, run it in an executor.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, **dump_options)
+        if durable:
+            json_file.flush()
+            os.fsync(json_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def replay_journal(path, apply):
+    """Calls ``apply`` with every entry of the JSON lines journal at ``path``. Returns the number of entries.
+
+    A torn last entry is cut off. A missing journal has no entries. Blocking, run it in an executor.
+    """
+    length = 0
+    try:
+        with open(path, 'rb+') as journal:
+            valid_length = 0
+            for line in journal:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Unterminated entry')
+                    entry = json.loads(line)
+                except ValueError:
+                    # Only the last write can be torn, cut it off so new entries start on a clean line
+                    logger.warning('Dropping torn journal entry of %s: %r', path, line)
+                    journal.truncate(valid_length)
+                    break
+                apply(entry)
+                length += 1
+                valid_length += len(line)
+    except FileNotFoundError:
+        pass
+    return length
@@ -0,0 +1,208 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+
+from utils import executor
+from utils.jsonfiles import write_atomic
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma', '.webm', '.mka')
+NON_WORD = re.compile(r'[^\w]+')
+CANDIDATE_TRIGRAMS = 4 # Rarest query trigrams used to collect candidates
+MAX_CANDIDATES = 256 # Entries scored per search, bounds the time a search holds the event loop
+SCAN_BATCH = 64
+
+
+def normalize(text):
+    return ' '.join(NON_WORD.sub(' ', text.lower()).split())
+
+
+def trigrams(text):
+    padded = '  {} '.format(normalize(text))
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def probe(path):
+    """Reads tags and duration of a file with ffprobe. Blocking, run it in an executor."""
+    process = subprocess.run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', path],
+                             check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    file_format = json.loads(process.stdout.decode('utf-8', 'replace')).get('format', {})
+    tags = {key.lower(): value for key, value in file_format.get('tags', {}).items()}
+    duration = file_format.get('duration')
+    return {
+        'title': tags.get('title') or os.path.splitext(os.path.basename(path))[0],
+        'artist': tags.get('artist') or tags.get('album_artist'),
+        'album': tags.get('album'),
+        'duration': float(duration) if duration else None,
+    }
+
+
+class LibraryIndex:
+    """On-disk index of local music with an in-memory trigram index for fuzzy search.
+
+    Scans are incremental: files whose mtime and size did not change are not probed again.
+    Searches run in executors, the trigram index is only changed under ``_lock``.
+    """
+
+    def __init__(self, directories=(), index_path='library-index.json', min_score=0.8, prefer_local=False):
+        self.directories = list(directories)
+        self.index_path = index_path
+        self.min_score = min_score
+        self.prefer_local = prefer_local
+        self.entries = {} # path -> {'title', 'artist', 'album', 'duration', 'mtime', 'size'}
+        self._trigrams = {} # path -> trigram set
+        self._postings = collections.defaultdict(set) # trigram -> paths
+        self._lock = threading.Lock()
+        self.scanning = False
+
+    @classmethod
+    def from_config(cls, config):
+        library_config = config.get('library', {})
+        return cls(directories=library_config.get('directories', []),
+                   index_path=library_config.get('index', 'library-index.json'),
+                   min_score=library_config.get('min_score', 0.8),
+                   prefer_local=library_config.get('prefer_local', False))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        try:
+            with open(self.index_path) as index_file:
+                entries = json.load(index_file)
+        except (OSError, ValueError):
+            entries = {}
+        with self._lock:
+            self.entries = {}
+            self._trigrams.clear()
+            self._postings.clear()
+            for path, entry in entries.items():
+                self._add(path, entry)
+
+    def write_index(self, entries):
+        write_atomic(self.index_path, entries, durable=False, separators=(',', ':')) # Rebuilt by the next scan if lost
+
+    def _add(self, path, entry):
+        if path in self.entries:
+            self._remove(path)
+        self.entries[path] = entry
+        grams = trigrams(' '.join(filter(None, (entry.get('artist'), entry['title']))))
+        self._trigrams[path] = grams
+        for gram in grams:
+            self._postings[gram].add(path)
+
+    def _remove(self, path):
+        del self.entries[path]
+        for gram in self._trigrams.pop(path):
+            postings = self._postings[gram]
+            postings.discard(path)
+            if not postings:
+                del self._postings[gram]
+
+    def _update(self, removed, added):
+        with self._lock:
+            for path in removed:
+                self._remove(path)
+            for path, entry in added.items():
+                self._add(path, entry)
+
+    def _walk(self):
+        """Lists every audio file with its mtime and size. Blocking, run it in an executor."""
+        found = {}
+        for directory in self.directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if not name.lower().endswith(AUDIO_EXTENSIONS):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_mtime, stat.st_size)
+        return found
+
+    async def scan(self, pool):
+        """Brings the index up to date, probing new and changed files in ``pool``."""
+        if self.scanning or not self.directories:
+            return
+        self.scanning = True
+        loop = asyncio.get_event_loop()
+        try:
+            found = await loop.run_in_executor(None, self._walk)
+            removed = [path for path in self.entries if path not in found]
+            await loop.run_in_executor(None, self._update, removed, {})
+            changed = [path for path, (mtime, size) in found.items()
+                       if path not in self.entries
+                       or (self.entries[path]['mtime'], self.entries[path]['size']) != (mtime, size)]
+
+            for start in range(0, len(changed), SCAN_BATCH):
+                batch = changed[start:start + SCAN_BATCH]
+                results = await asyncio.gather(*(pool.run(executor.PREFETCH, probe, path) for path in batch),
+                                               return_exceptions=True)
+                added = {}
+                for path, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logger.warning('Could not probe %s: %s', path, result)
+                        continue
+                    result['mtime'], result['size'] = found[path]
+                    added[path] = result
+                await loop.run_in_executor(None, self._update, (), added)
+
+            await loop.run_in_executor(None, self.write_index, dict(self.entries))
+            logger.info('Library scan done: %d files indexed, %d probed', len(self.entries), len(changed))
+        finally:
+            self.scanning = False
+
+    def search(self, query, limit=5):
+        """Returns up to ``limit`` (score, path, entry) tuples, best match first. Blocking, run it in an executor."""
+        with self._lock:
+            return self._search(query, limit)
+
+    def _search(self, query, limit):
+        query_grams = trigrams(query)
+        present = [gram for gram in query_grams if gram in self._postings]
+        if not present:
+            return []
+        # Collecting candidates from the rarest trigrams keeps lookups cheap on huge libraries
+        present.sort(key=lambda gram: len(self._postings[gram]))
+        candidates = self._postings[present[0]]
+        if len(candidates) <= MAX_CANDIDATES:
+            candidates = set(candidates)
+            for gram in present[1:CANDIDATE_TRIGRAMS]:
+                postings = self._postings[gram]
+                if len(candidates) + len(postings) > MAX_CANDIDATES:
+                    break
+                candidates |= postings
+        else:
+            # Only common trigrams, narrow down to the entries that contain several of the rarest ones
+            for gram in present[1:CANDIDATE_TRIGRAMS]:
+                narrowed = candidates & self._postings[gram]
+                if not narrowed:
+                    break
+                candidates = narrowed
+                if len(candidates) <= MAX_CANDIDATES:
+                    break
+            candidates = itertools.islice(candidates, MAX_CANDIDATES)
+
+        scored = []
+        for path in candidates:
+            grams = self._trigrams[path]
+            overlap = len(query_grams & grams)
+            # Containment of the query first, closeness of the whole text breaks ties
+            scored.append((overlap / len(query_grams), overlap / (len(query_grams) + len(grams) - overlap), path))
+        scored.sort(reverse=True)
+        return [(score, path, self.entries[path]) for score, _, path in scored[:limit]]
+
+    def best_match(self, query):
+        results = self.search(query, limit=1)
+        if results and results[0][0] >= self.min_score:
+            return results[0][1], results[0][2]
+        return None
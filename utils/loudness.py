@@ -0,0 +1,34 @@
+import math
+import re
+import subprocess
+
+INTEGRATED_LOUDNESS = re.compile(r'I:\s+(-?\d+(?:\.\d+)?) LUFS')
+MAX_GAIN = 12.0 # dB, never boost quiet tracks (and their noise floor) further than this
+
+
+def measure_integrated_loudness(filename):
+    """Measures EBU R128 integrated loudness in LUFS with FFmpeg's ebur128 filter.
+
+    Blocking, run it in an executor.
+    """
+    process = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', filename, '-vn',
+                              '-af', 'ebur128=framelog=quiet', '-f', 'null', '-'],
+                             check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    matches = INTEGRATED_LOUDNESS.findall(process.stderr.decode('utf-8', 'replace'))
+    if not matches:
+        raise ValueError('No loudness summary in FFmpeg output for {}'.format(filename))
+    return float(matches[-1]) # The summary comes last
+
+
+def measure_gain(filename, target=-16.0):
+    """Returns the gain in dB that brings the file to the target loudness."""
+    loudness = measure_integrated_loudness(filename)
+    return max(min(target - loudness, MAX_GAIN), -MAX_GAIN * 2)
+
+
+def gain_to_factor(gain):
+    return 10 ** (gain / 20)
+
+
+def factor_to_gain(factor):
+    return 20 * math.log10(factor)
@@ -0,0 +1,105 @@
+import collections
+
+SEPARATOR = '\x00' # Joins the scanned fields, can't be part of a pattern typed in Discord
+
+
+class PatternMatcher:
+    """Aho-Corasick automaton finding any of a set of substrings in a single pass.
+
+    Patterns are inserted into or unmarked in the trie right away, the failure links
+    are recomputed lazily on the next search.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = set()
+        self._reset()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def _reset(self):
+        self._goto = [{}]
+        self._output = [None] # Pattern ending at each node
+        self._fail = [0]
+        self._match = [None] # Longest pattern ending at a node or one of its suffixes
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def add(self, pattern):
+        if not pattern or pattern in self.patterns:
+            return
+        self.patterns.add(pattern)
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._output.append(None)
+            node = next_node
+        self._output[node] = pattern
+        self._dirty = True
+
+    def remove(self, pattern):
+        self.patterns.remove(pattern)
+        node = 0
+        for char in pattern:
+            node = self._goto[node][char]
+        self._output[node] = None # The now unused trie nodes are simply never matched
+        self._dirty = True
+
+    def _build_links(self):
+        node_count = len(self._goto)
+        self._fail = [0] * node_count
+        self._match = list(self._output)
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                if self._match[child] is None:
+                    self._match[child] = self._match[self._fail[child]]
+        self._dirty = False
+
+    def search(self, text):
+        """Returns the first pattern found in ``text``, or None."""
+        if not self.patterns:
+            return None
+        if self._dirty:
+            self._build_links()
+        goto, fail, match = self._goto, self._fail, self._match
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if match[node] is not None:
+                return match[node]
+        return None
+
+
+class BlacklistMatcher(PatternMatcher):
+    """Matches song info against the video blacklist.
+
+    Exact video IDs are answered from the pattern set in O(1), everything else with
+    a single scan over all fields.
+    """
+    FIELDS = ('title', 'description', 'id', 'uploader')
+
+    def match(self, info):
+        video_id = info.get('id')
+        if video_id in self.patterns:
+            return video_id
+        return self.search(SEPARATOR.join(info.get(field) or '' for field in self.FIELDS))
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+import threading
+import time
+
+from yarl import URL
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    info TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+)
+'''
+
+
+class MetadataCache:
+    """sqlite backed cache for youtube_dl resolution results.
+
+    Every method is blocking, run them in an executor. Results that carry
+    stream URLs expire after ``stream_ttl`` since those URLs are signed and short lived.
+    """
+
+    def __init__(self, path='metadata-cache.sqlite3', ttl=7 * 24 * 3600, stream_ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.stream_ttl = stream_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Cluster workers share the database, wait for their writes instead of failing
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get('metadata_cache', {})
+        return cls(path=cache_config.get('path', 'metadata-cache.sqlite3'),
+                   ttl=cache_config.get('ttl', 7 * 24 * 3600),
+                   stream_ttl=cache_config.get('stream_ttl', 3600))
+
+    @staticmethod
+    def normalize(query):
+        """Normalizes a query so that trivially different spellings share an entry."""
+        query = ' '.join(query.split())
+        if not query.startswith(('http://', 'https://')):
+            return query
+        url = URL(query)
+        if url.host in ('youtu.be', 'www.youtu.be'):
+            return 'youtube:' + url.path[1:]
+        if url.host and url.host.endswith('youtube.com') and 'v' in url.query:
+            return 'youtube:' + url.query['v']
+        return str(url.with_host(url.host.lower()).with_fragment(None)) if url.host else query
+
+    @staticmethod
+    def has_stream_urls(info):
+        return 'formats' in info or ('url' in info and info.get('_type') not in ('url', 'url_transparent'))
+
+    def get(self, kind, query):
+        with self._lock:
+            row = self._db.execute('SELECT info, expires FROM metadata WHERE kind = ? AND key = ?',
+                                   (kind, self.normalize(query))).fetchone()
+        if row is None or row[1] < time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, kind, query, info):
+        ttl = self.stream_ttl if self.has_stream_urls(info) else self.ttl
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO metadata (kind, key, info, expires) VALUES (?, ?, ?, ?)',
+                             (kind, self.normalize(query), json.dumps(info, default=str), time.time() + ttl))
+
+    def purge(self):
+        """Drops expired entries."""
+        with self._lock:
+            self._db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
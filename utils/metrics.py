@@ -0,0 +1,197 @@
+import asyncio
+import bisect
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        (registry or REGISTRY).register(self)
+
+    def samples(self):
+        """Yields (suffix, label names, label values, value) tuples."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(names, values), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.values = {}
+        super().__init__(name, documentation, labels, registry)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield '_total', self.labels, labels, value
+
+
+class Gauge(Metric):
+    """Gauge that is either set directly or read from ``callback`` when scraped.
+
+    A callback returns a number, or a dict of label value tuples to numbers for labelled gauges.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), registry=None, callback=None):
+        self.values = {}
+        self.callback = callback
+        super().__init__(name, documentation, labels, registry)
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.values
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in values.items():
+            yield '', self.labels, labels, value
+
+
+class CallbackCounter(Gauge):
+    """Counter maintained elsewhere, e.g. cache hit counts, read when scraped."""
+    kind = 'counter'
+
+    def samples(self):
+        for _, names, labels, value in super().samples():
+            yield '_total', names, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.values = {} # labels -> [bucket counts, sum, count]
+        super().__init__(name, documentation, labels, registry)
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        bucket_labels = self.labels + ('le',)
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', bucket_labels, labels + (format_value(bound),), cumulative
+            yield '_sum', self.labels, labels, total
+            yield '_count', self.labels, labels, count
+
+
+class Timer:
+    """Context manager observing the elapsed time into a histogram."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # Reloading a cog defines its metrics again, the new definition wins
+        self.metrics[metric.name] = metric
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def render(self):
+        parts = []
+        for metric in list(self.metrics.values()):
+            try:
+                parts.append(metric.render())
+            except Exception:
+                logger.exception('Could not render metric %s', metric.name)
+        return '\n'.join(parts) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """Minimal HTTP server exposing a registry in the Prometheus text format."""
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass # Headers are not needed
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.registry.render().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, content_type, len(body)).encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
@@ -0,0 +1,142 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+
+import discord
+
+# Priority classes, lower runs first. Command replies are sent directly and always go first.
+ANNOUNCE = 0
+COSMETIC = 1
+
+logger = logging.getLogger('musicbot2.outbound')
+
+
+class OutboundScheduler:
+    """Queues the Discord calls that are not command replies, one queue per rate limit bucket.
+
+    Every bucket sends one call at a time in priority order, so a backlog of announcements
+    and reactions waits here instead of in front of command replies in discord.py's own
+    bucket locks. Actions with the same key replace each other while they wait, and a
+    reaction that is removed before it was ever added is not sent at all.
+
+    The presence is global, so it is never queued: it is recomputed from ``presence``
+    whenever something changed, and set at most once every ``presence_interval`` seconds.
+    """
+
+    def __init__(self, bot, presence=None, presence_interval=15, max_queued=50):
+        self.bot = bot
+        self.loop = bot.loop
+        self.presence = presence
+        self.presence_interval = presence_interval
+        self.max_queued = max_queued
+        self.buckets = {} # bucket -> heap of [priority, seq, key, factory, tag]
+        self.workers = {} # bucket -> task draining it
+        self.pending = {} # key -> queued entry
+        self.sent = 0
+        self.dropped = collections.Counter()
+        self._counter = itertools.count()
+        self._presence_changed = asyncio.Event()
+        self._activity = None
+        self.presence_task = self.loop.create_task(self._update_presence()) if presence is not None else None
+
+    @classmethod
+    def from_config(cls, bot, config, presence=None):
+        outbound_config = config.get('outbound', {})
+        return cls(bot, presence=presence,
+                   presence_interval=outbound_config.get('presence_interval', 15),
+                   max_queued=outbound_config.get('max_queued', 50))
+
+    @property
+    def queued(self):
+        return sum(1 for queue in self.buckets.values() for entry in queue if entry[3] is not None)
+
+    def submit(self, bucket, priority, factory, key=None, tag=None):
+        """Queues ``factory()`` in the bucket, replacing a queued action with the same key."""
+        queue = self.buckets.setdefault(bucket, [])
+        if priority == COSMETIC and len(queue) >= self.max_queued:
+            self.dropped['overflow'] += 1
+            return
+        if key is not None:
+            self._cancel(key, 'superseded')
+        entry = [priority, next(self._counter), key, factory, tag]
+        if key is not None:
+            self.pending[key] = entry
+        heapq.heappush(queue, entry)
+        if bucket not in self.workers:
+            self.workers[bucket] = self.loop.create_task(self._drain(bucket))
+
+    def _cancel(self, key, reason):
+        entry = self.pending.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+            self.dropped[reason] += 1
+        return entry
+
+    async def _drain(self, bucket):
+        queue = self.buckets[bucket]
+        try:
+            while queue:
+                entry = heapq.heappop(queue)
+                _, _, key, factory, _ = entry
+                if factory is None:
+                    continue
+                if key is not None and self.pending.get(key) is entry:
+                    del self.pending[key]
+                try:
+                    await factory()
+                except discord.HTTPException as e:
+                    logger.debug('Outbound action in %s failed: %s', bucket, e)
+                except Exception:
+                    logger.exception('Outbound action in %s failed', bucket)
+                else:
+                    self.sent += 1
+        finally:
+            del self.workers[bucket]
+            del self.buckets[bucket]
+
+    def send(self, channel, content, key=None, priority=ANNOUNCE):
+        self.submit(('messages', channel.id), priority, lambda: channel.send(content), key=key)
+
+    def add_reaction(self, message, emoji):
+        self._react(message, emoji, True, lambda: message.add_reaction(emoji))
+
+    def remove_reaction(self, message, emoji, member):
+        self._react(message, emoji, False, lambda: message.remove_reaction(emoji, member))
+
+    def _react(self, message, emoji, add, factory):
+        key = ('reaction', message.id, emoji)
+        pending = self.pending.get(key)
+        if pending is not None:
+            # A queued opposite change cancels out with this one, a queued identical one makes it redundant
+            self._cancel(key, 'superseded')
+            if pending[4] != add:
+                return
+        self.submit(('reactions', message.channel.id), COSMETIC, factory, key=key, tag=add)
+
+    def presence_changed(self):
+        self._presence_changed.set()
+
+    async def _update_presence(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await self._presence_changed.wait()
+            self._presence_changed.clear()
+            activity = self.presence()
+            if activity == self._activity:
+                continue
+            try:
+                await self.bot.change_presence(activity=activity)
+            except Exception:
+                logger.exception('Could not update the presence')
+            else:
+                self._activity = activity
+                self.sent += 1
+            await asyncio.sleep(self.presence_interval)
+
+    def close(self):
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+        for task in self.workers.values():
+            task.cancel()
@@ -0,0 +1,100 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_STALLS = metrics.Counter('musicbot_event_loop_stalls', 'Event loop stalls longer than the watchdog threshold.')
+
+
+class LoopWatchdog:
+    """Reports event loop stalls together with the stack that is blocking the loop.
+
+    A coroutine on the loop keeps a heartbeat, a daemon thread checks it and grabs the
+    loop thread's current frame once the heartbeat is older than ``threshold`` seconds.
+    """
+
+    def __init__(self, loop, threshold=0.25, interval=0.05):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def _heartbeat(self):
+        self.loop_thread_id = threading.get_ident()
+        while not self._stopped.is_set():
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self.last_beat
+            stalled_for = time.monotonic() - beat
+            if stalled_for < self.threshold or beat == reported_beat or self.loop_thread_id is None:
+                continue
+            reported_beat = beat # Report every stall once
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '<no frame>\n'
+            LOOP_STALLS.inc()
+            logger.warning('Event loop blocked for over %.3fs, current stack:\n%s', stalled_for, stack)
+
+
+class SamplingProfiler:
+    """Low overhead sampling profiler for every Python thread of the process.
+
+    Samples are collapsed into ``frame;frame;frame count`` lines, which flamegraph.pl,
+    speedscope and similar tools read directly.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _frame_name(frame):
+        """``module:function``, without the line number so all samples of a function collapse into one frame."""
+        code = frame.f_code
+        module = frame.f_globals.get('__name__') or os.path.basename(code.co_filename)
+        return '{}:{}'.format(module, getattr(code, 'co_qualname', code.co_name)) # co_qualname is new in Python 3.11
+
+    def run(self, duration):
+        """Samples for ``duration`` seconds. Blocking, run it in its own thread."""
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names: # Started while we are sampling
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
@@ -0,0 +1,157 @@
+import asyncio
+import copy
+import functools
+import json
+import logging
+import os
+import threading
+
+from utils.jsonfiles import replay_journal, write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+def empty_state():
+    return {'voice_channel': None, 'volume': None, 'min_skips': None,
+            'current': None, 'position': 0.0, 'queue': []}
+
+
+def apply_event(state, event):
+    """Applies one journal event to a guild state."""
+    op = event[0]
+    if op == 'add':
+        state['queue'].append([event[1], event[2]])
+    elif op == 'remove':
+        state['queue'] = [item for item in state['queue'] if item[0] != event[1]]
+    elif op == 'clear':
+        state['queue'] = []
+    elif op == 'play':
+        handle, state['voice_channel'] = event[1], event[2]
+        for idx, (queued_handle, entry) in enumerate(state['queue']):
+            if queued_handle == handle:
+                state['current'] = entry
+                del state['queue'][idx]
+                break
+        state['position'] = 0.0
+    elif op == 'position':
+        state['position'] = event[1]
+    elif op == 'settings':
+        state.update(event[1])
+    elif op == 'stop':
+        state['current'] = None
+        state['queue'] = []
+
+
+class QueueStore:
+    """Crash safe persistence of every guild's queue.
+
+    Each guild has a compact snapshot and an append-only journal of events in
+    ``directory``. Events are buffered and written in order off the event loop, the
+    journal is folded into a new snapshot once it holds ``compact_after`` entries.
+    """
+
+    def __init__(self, directory='queue-state', compact_after=200):
+        self.directory = directory
+        self.compact_after = compact_after
+        self.states = {} # guild id -> state as of the last recorded event
+        self.journal_lengths = {}
+        self._pending = []
+        self._flush_task = None
+        self._write_lock = threading.Lock() # A cancelled flush may still be writing when close writes the rest
+
+    @classmethod
+    def from_config(cls, config):
+        store_config = config.get('queue_state', {})
+        return cls(directory=store_config.get('directory', 'queue-state'),
+                   compact_after=store_config.get('compact_after', 200))
+
+    def _path(self, guild_id, suffix):
+        return os.path.join(self.directory, '{}{}'.format(guild_id, suffix))
+
+    def load_all(self, owned=None):
+        """Rebuilds every stored guild state from its snapshot and journal. Blocking, call at startup.
+
+        ``owned`` limits loading to the guilds it returns True for, so a cluster worker
+        never touches the journals other workers are writing.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        guild_ids = {int(name.split('.')[0]) for name in os.listdir(self.directory) if name.split('.')[0].isdigit()}
+        if owned is not None:
+            guild_ids = {guild_id for guild_id in guild_ids if owned(guild_id)}
+        for guild_id in guild_ids:
+            try:
+                with open(self._path(guild_id, '.json')) as snapshot:
+                    state = json.load(snapshot)
+            except (FileNotFoundError, ValueError):
+                state = empty_state()
+            self.journal_lengths[guild_id] = replay_journal(self._path(guild_id, '.journal'),
+                                                            functools.partial(apply_event, state))
+            self.states[guild_id] = state
+        return {guild_id: copy.deepcopy(state) for guild_id, state in self.states.items()
+                if state['current'] is not None or state['queue']}
+
+    def record(self, guild_id, *event):
+        state = self.states.setdefault(guild_id, empty_state())
+        apply_event(state, list(event))
+        if event[0] == 'stop':
+            self.journal_lengths[guild_id] = 0
+            self._submit(('snapshot', guild_id, copy.deepcopy(state)))
+            return
+        self._submit(('append', guild_id, json.dumps(event) + '\n'))
+        self.journal_lengths[guild_id] = self.journal_lengths.get(guild_id, 0) + 1
+        if self.journal_lengths[guild_id] >= self.compact_after:
+            self.journal_lengths[guild_id] = 0
+            self._submit(('snapshot', guild_id, copy.deepcopy(state)))
+
+    def reset(self, guild_id, state):
+        """Replaces a guild's stored state, used after handles were reassigned on restore."""
+        self.states[guild_id] = state
+        self.journal_lengths[guild_id] = 0
+        self._submit(('snapshot', guild_id, copy.deepcopy(state)))
+
+    def _submit(self, op):
+        self._pending.append(op)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush())
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        while self._pending:
+            ops, self._pending = self._pending, []
+            try:
+                await loop.run_in_executor(None, self._write, ops)
+            except OSError:
+                logger.exception('Could not persist queue state')
+
+    def _write(self, ops):
+        with self._write_lock:
+            self._write_ops(ops)
+
+    def _write_ops(self, ops):
+        journals = {}
+        try:
+            for kind, guild_id, payload in ops:
+                if kind == 'append':
+                    if guild_id not in journals:
+                        journals[guild_id] = open(self._path(guild_id, '.journal'), 'a')
+                    journals[guild_id].write(payload)
+                    continue
+                # Snapshot, everything journaled so far is part of it
+                journal = journals.pop(guild_id, None)
+                if journal is not None:
+                    journal.close()
+                write_atomic(self._path(guild_id, '.json'), payload, separators=(',', ':'))
+                open(self._path(guild_id, '.journal'), 'w').close()
+        finally:
+            for journal in journals.values():
+                journal.flush()
+                os.fsync(journal.fileno())
+                journal.close()
+
+    async def close(self):
+        """Waits until every recorded event has been written, including the ones of a cancelled flush."""
+        if self._flush_task is not None:
+            await asyncio.wait({self._flush_task})
+        if self._pending:
+            ops, self._pending = self._pending, []
+            await asyncio.get_event_loop().run_in_executor(None, self._write, ops)
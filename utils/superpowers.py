@@ -1,19 +1,88 @@
 from discord.ext import commands
 
+
+class PermissionCache:
+    """Privileged role ids per guild and the application owner, so the checks skip the scans.
+
+    The configured role names are resolved to role ids once per guild and the application
+    owner is fetched once. The member's own roles are read on every check, so revoking a
+    role applies at once. Role and guild events drop the affected guild.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.role_ids = {} # guild id -> (super power role ids, owner role ids)
+        self.owner_id = None
+        for listener in (self.on_guild_role_create, self.on_guild_role_update, self.on_guild_role_delete, self.on_guild_remove):
+            bot.add_listener(listener)
+        bot.add_listener(self.on_config_reload)
+
+    def _role_ids(self, guild):
+        role_ids = self.role_ids.get(guild.id)
+        if role_ids is None:
+            super_power_roles = self.bot.config.super_power_roles
+            owner_role = self.bot.config.owner_role
+            role_ids = self.role_ids[guild.id] = (frozenset(role.id for role in guild.roles if role.name in super_power_roles),
+                                                  frozenset(role.id for role in guild.roles if role.name == owner_role))
+        return role_ids
+
+    def privileges(self, member):
+        """Returns whether the member has super powers and whether they have the owner role."""
+        guild = getattr(member, 'guild', None)
+        if guild is None: # Users outside of a guild have no roles
+            return False, False
+        super_power_ids, owner_ids = self._role_ids(guild)
+        return (not super_power_ids.isdisjoint(role.id for role in member.roles),
+                not owner_ids.isdisjoint(role.id for role in member.roles))
+
+    async def get_owner_id(self):
+        if self.owner_id is None:
+            app_info = await self.bot.application_info()
+            self.owner_id = app_info.owner.id
+        return self.owner_id
+
+    def clear(self):
+        """Forgets every guild, e.g. when the configured role names changed."""
+        self.role_ids.clear()
+
+    def forget_guild(self, guild_id):
+        self.role_ids.pop(guild_id, None)
+
+    async def on_config_reload(self, old, new):
+        self.clear()
+
+    async def on_guild_role_create(self, role):
+        self.forget_guild(role.guild.id)
+
+    async def on_guild_role_update(self, before, after):
+        self.forget_guild(after.guild.id)
+
+    async def on_guild_role_delete(self, role):
+        self.forget_guild(role.guild.id)
+
+    async def on_guild_remove(self, guild):
+        self.forget_guild(guild.id)
+
+
+def get_permission_cache(bot):
+    cache = getattr(bot, 'permission_cache', None)
+    if cache is None:
+        cache = bot.permission_cache = PermissionCache(bot)
+    return cache
+
 def has_super_powers():
     return commands.check(not_check_has_super_powers)
 
 async def not_check_has_super_powers(ctx: commands.Context):
-    user_role_list = [x.name for x in ctx.author.roles]
-    return any(x in user_role_list for x in ctx.bot.config["super_power_roles"])
+    super_powers, _ = get_permission_cache(ctx.bot).privileges(ctx.author)
+    return super_powers
 
 def is_special_owner():
     return commands.check(not_check_is_special_owner)
 
 async def not_check_is_special_owner(ctx: commands.Context):
-    app_info = await ctx.bot.application_info()
-    if ctx.author.id == app_info.owner.id: # If we're owner we're owner.
+    cache = get_permission_cache(ctx.bot)
+    if ctx.author.id == await cache.get_owner_id(): # If we're owner we're owner.
         return True
-    owner_role_name = ctx.bot.config["owner_role"]
-    user_role_list = [x.name for x in ctx.author.roles]
-    return owner_role_name in user_role_list
\ No newline at end of file
+    _, owner_role = cache.privileges(ctx.author)
+    return owner_role